@@ -20,8 +20,18 @@ if __name__ == '__main__':
 		from yiaygenerator import clips
 		if '--model' in argv:
 			clips.model_setup()
+		if '--migrate-stt' in argv:  # move JSON transcripts into the transcript store
+			clips.transcripts.migrate(clips.stt.json_path)
+		if '--index' in argv:  # index clips written before the clip index existed
+			clips.catalogue.rebuild(clips.rendering.clips_path)
 		
-		clips.make_all()
+		if '--normalize' in argv:  # normalize (and make proxies of) clips written before they existed
+			clips.normalizing.normalize_all()
+		
+		if '--pipeline' in argv:
+			clips.make_all_pipelined()
+		else:
+			clips.make_all(int(argv[argv.index('--jobs') + 1]) if '--jobs' in argv else 1)
 	
 	else:
 		execute_from_command_line(argv)
@@ -9,5 +9,6 @@ What it does:
 	- splits the video to clips and writes them to files
 """
 
-from .rendering import make_all, get_list, ClipList
+from .rendering import make_all, make_all_pipelined, get_list, ClipList
+from . import catalogue, normalizing, transcripts
 from .stt import model_setup
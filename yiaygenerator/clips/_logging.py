@@ -3,10 +3,19 @@
 from typing import Dict
 
 import logging
+import threading
 
 
 class _IndexAdapter(logging.LoggerAdapter):
-	ind: int
+	_local = threading.local()  # the builder may work on several videos at once in different threads
+	
+	@property
+	def ind(self) -> int:
+		return getattr(self._local, 'ind', 0)
+	
+	@ind.setter
+	def ind(self, ind: int) -> None:
+		self._local.ind = ind
 	
 	def process(self, msg: str, kwargs: Dict):
 		return f'YIAY#{self.ind:03d}:{msg}', kwargs
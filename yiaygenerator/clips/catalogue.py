@@ -0,0 +1,285 @@
+"""
+Keeps an on-disk index of the written clips,
+so the clip list can be loaded without walking the clips directory.
+
+Each clip may also have a normalized version (see the normalizing module),
+which is used instead of the original clip when it's up to date,
+and a low resolution proxy, which is used for previews.
+
+The loaded clip list is stored in flat arrays grouped by word,
+so it can be shared by all the requests of a process,
+and each request draws clips from it with its own lightweight sampler.
+"""
+
+from typing import NamedTuple, Optional, Iterable, List, Dict, Tuple, Iterator
+
+from .. import ffmpeg
+from . import profiles
+from ._logging import logger
+
+import sys
+import random
+import sqlite3
+import itertools
+import contextlib
+from array import array
+from pathlib import Path
+
+db_path = Path('expr/clips.sqlite3')
+
+
+class Clip(NamedTuple):
+	"""A single clip of Jack saying a word or a part of a YIAY video."""
+	word: str
+	episode: int
+	start: float
+	end: float
+	duration: float
+	width: int
+	height: int
+	path: Path
+	normalized: Optional[Path] = None
+	"""Path to the clip's normalized version."""
+	profile: Optional[str] = None
+	"""The encoding profile of the normalized version."""
+	stamp: Optional[str] = None
+	"""The state of the original clip file when it was normalized."""
+	proxy: Optional[Path] = None
+	"""Path to the clip's preview version."""
+	proxy_profile: Optional[str] = None
+	"""The encoding profile of the preview version."""
+
+
+_COLUMNS = (
+	'word, episode, start, "end", duration, width, height, path, normalized, profile, stamp, proxy, proxy_profile'
+)
+
+
+@contextlib.contextmanager
+def _connect() -> sqlite3.Connection:
+	"""Opens a connection to the index, and commits when done."""
+	# several build processes may write at the same time, so wait for each other's locks
+	connection = sqlite3.connect(str(db_path), timeout=60)
+	try:
+		with connection:
+			connection.execute(
+				'CREATE TABLE IF NOT EXISTS clips ('
+				'path TEXT PRIMARY KEY, word TEXT NOT NULL, episode INTEGER NOT NULL, '
+				'start REAL, "end" REAL, duration REAL, width INTEGER, height INTEGER)'
+			)
+			# columns that were added after the index was created
+			existing = {row[1] for row in connection.execute('PRAGMA table_info(clips)')}
+			for column in 'normalized', 'profile', 'stamp', 'proxy', 'proxy_profile':
+				if column not in existing:
+					connection.execute(f'ALTER TABLE clips ADD COLUMN {column} TEXT')
+			
+			connection.execute('CREATE INDEX IF NOT EXISTS clips_word ON clips (word)')
+			connection.execute('CREATE INDEX IF NOT EXISTS clips_normalized ON clips (normalized)')
+			connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+			yield connection
+	finally:
+		connection.close()
+
+
+def add(clips: Iterable[Clip]) -> None:
+	"""Adds clips to the index, replacing existing clips with the same path."""
+	with _connect() as db:
+		db.executemany(
+			f'INSERT OR REPLACE INTO clips ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+			(
+				(
+					*c[:7], str(c.path),
+					c.normalized and str(c.normalized), c.profile, c.stamp,
+					c.proxy and str(c.proxy), c.proxy_profile,
+				) for c in clips
+			)
+		)
+		_bump_version(db)
+
+
+def all_clips() -> List[Clip]:
+	"""Returns all the indexed clips."""
+	with _connect() as db:
+		return [_from_row(row) for row in db.execute(f'SELECT {_COLUMNS} FROM clips')]
+
+
+class Catalogue:
+	"""
+	The available clips (their normalized versions when they are up to date),
+	stored in flat arrays where the clips of each word are a contiguous range.
+	"""
+	def __init__(
+			self, version: int, rows: Iterable[Tuple[str, str, int, Optional[float], bool, Optional[str]]]
+	) -> None:
+		"""
+		:param version: the version of the index the clips were loaded from
+		:param rows:
+			word, path, episode, duration, whether the clip is normalized and an up-to-date proxy (or None),
+			sorted by word
+		"""
+		self.version = version
+		self.paths: List[str] = []
+		self.episodes = array('i')
+		self.durations = array('d')
+		self.normalized = array('b')
+		self.proxies: List[Optional[str]] = []
+		self._ranges: Dict[str, Tuple[int, int]] = {}
+		
+		for word, clips in itertools.groupby(rows, key=lambda row: row[0]):
+			start = len(self.paths)
+			for _, path, episode, duration, normalized, proxy in clips:
+				self.paths.append(path)
+				self.episodes.append(episode)
+				self.durations.append(duration or 0.0)
+				self.normalized.append(normalized)
+				self.proxies.append(proxy)
+			self._ranges[sys.intern(word)] = start, len(self.paths)
+	
+	def __contains__(self, word: str) -> bool:
+		return word in self._ranges
+	
+	def __iter__(self) -> Iterator[str]:
+		return iter(self._ranges)
+	
+	def __len__(self) -> int:
+		return len(self._ranges)
+	
+	def clips(self, word: str) -> range:
+		"""Returns the indexes of the clips of a word."""
+		return range(*self._ranges[word])
+	
+	def path(self, i: int, preview: bool = False) -> Path:
+		"""Returns the path of a clip, or of its proxy for previews (if it has one)."""
+		return Path(preview and self.proxies[i] or self.paths[i])
+	
+	def sampler(self) -> 'Sampler':
+		"""Creates a sampler to draw clips from the catalogue for a single request."""
+		return Sampler(self)
+
+
+class Sampler:
+	"""
+	Draws random clips of words without replacement,
+	until all the clips of a word were drawn and it starts over.
+	
+	Each word has a lazy Fisher-Yates shuffle of its clips' indexes,
+	which only stores the swapped indexes, so a draw costs O(1) without copying anything.
+	"""
+	def __init__(self, catalogue: Catalogue) -> None:
+		self.catalogue = catalogue
+		self._drawn: Dict[str, int] = {}
+		self._swaps: Dict[str, Dict[int, int]] = {}
+	
+	def draw(self, word: str) -> int:
+		"""
+		Draws a random clip of a word.
+		
+		:param word: the word to draw a clip of
+		:return: the clip's index in the catalogue
+		:raise KeyError: if there are no clips of the word
+		"""
+		clips = self.catalogue.clips(word)
+		drawn = self._drawn.get(word, 0)
+		if drawn == len(clips):  # start over
+			drawn = 0
+			self._swaps[word] = {}
+		swaps = self._swaps.setdefault(word, {})
+		
+		j = random.randrange(drawn, len(clips))
+		i = swaps.get(j, j)
+		swaps[j] = swaps.get(drawn, drawn)
+		
+		self._drawn[word] = drawn + 1
+		return clips[i]
+
+
+def load() -> Catalogue:
+	"""Loads the available clips from the index."""
+	current = profiles.PROFILE.name
+	preview = profiles.PREVIEW.name
+	with _connect() as db:
+		rows = db.execute(
+			'SELECT word, path, episode, normalized, profile, duration, proxy, proxy_profile FROM clips ORDER BY word'
+		)
+		return Catalogue(_version(db), (
+			(
+				word, normalized if profile == current else path, episode, duration, profile == current,
+				proxy if proxy_profile == preview else None,
+			) for word, path, episode, normalized, profile, duration, proxy, proxy_profile in rows
+		))
+
+
+def version() -> int:
+	"""Returns a number that changes whenever the index does."""
+	with _connect() as db:
+		return _version(db)
+
+
+def _version(db: sqlite3.Connection) -> int:
+	row = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+	return row[0] if row else 0
+
+
+def _bump_version(db: sqlite3.Connection) -> None:
+	db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0)")
+	db.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+
+
+def lookup(word: str) -> List[Clip]:
+	"""Returns all the indexed clips of a word."""
+	with _connect() as db:
+		return [
+			_from_row(row) for row in db.execute(f'SELECT {_COLUMNS} FROM clips WHERE word = ?', (word,))
+		]
+
+
+def get(path: Path) -> Optional[Clip]:
+	"""Returns the indexed clip at a path (original or normalized), if there is one."""
+	with _connect() as db:
+		row = db.execute(
+			f'SELECT {_COLUMNS} FROM clips WHERE path = ? OR normalized = ?', (str(path), str(path))
+		).fetchone()
+	
+	return row and _from_row(row)
+
+
+def clear() -> None:
+	"""Removes all clips from the index."""
+	with _connect() as db:
+		db.execute('DELETE FROM clips')
+		_bump_version(db)
+
+
+def rebuild(clips_path: Path) -> None:
+	"""
+	Builds the index from an existing clips directory,
+	for clips that were written before the index existed.
+	Start and end times are unknown for these clips.
+	
+	:param clips_path: the directory containing a directory per word
+	"""
+	clear()
+	for word in clips_path.iterdir():
+		logger.info(f'Indexing clips of {word.name}...')
+		clips = []
+		for path in word.iterdir():
+			try:
+				info = ffmpeg.info(path)
+			except IOError:
+				logger.warning(f'Skipping unreadable clip {path}')
+				continue
+			
+			clips.append(Clip(
+				word.name, int(path.name.split('-')[0]),
+				None, None, info.duration,
+				info.width, info.height, path,
+			))
+		add(clips)
+
+
+def _from_row(row: tuple) -> Clip:
+	*fields, path, normalized, profile, stamp, proxy, proxy_profile = row
+	return Clip(
+		*fields, Path(path), normalized and Path(normalized), profile, stamp,
+		proxy and Path(proxy), proxy_profile,
+	)
@@ -0,0 +1,121 @@
+"""
+Cuts a video file into many clips in a few ffmpeg passes.
+
+Instead of decoding the video again for every clip, a single pass writes many clips:
+	- clips that start shortly after a keyframe are copied from that keyframe,
+	  and the mp4 edit list hides the frames before their start (so they're trimmed when they're played)
+	- the others are re-encoded whole, in smaller passes (every output has its own encoder)
+A re-encoded part can't be joined to a copied one, because the encoder's parameter sets (SPS/PPS)
+never match the source's, and an mp4 file only has one set for the whole stream.
+"""
+
+from typing import NamedTuple, Sequence, List, Tuple, Optional
+
+from .. import ffmpeg
+from ._logging import logger
+
+import bisect
+import tempfile
+from os import PathLike
+from pathlib import Path
+
+BATCH_SIZE = 64
+"""Maximum number of copied clips for a single ffmpeg pass (each one has its own demuxer and muxer)."""
+ENCODE_BATCH_SIZE = 8
+"""Maximum number of re-encoded clips for a single ffmpeg pass (each one has its own x264 encoder)."""
+MAX_LEAD_IN = 1.0
+"""
+Maximum time between a keyframe and the start of a clip to copy from it
+(the frames in between are kept in the file, hidden by the edit list).
+"""
+KEYFRAME_TOLERANCE = 0.01
+"""Keyframes this close after the start of a clip are treated as its start."""
+
+
+class Cut(NamedTuple):
+	"""A single clip to cut out of a video."""
+	start: float
+	end: float
+	path: Path
+
+
+def cut(source: PathLike, cuts: Sequence[Cut]) -> List[Cut]:
+	"""
+	Cuts clips out of a video file.
+	
+	:param source: path to the video file
+	:param cuts: the clips to cut
+	:return: the clips that failed to be written
+	"""
+	keyframes = ffmpeg.keyframes(source)
+	
+	with tempfile.TemporaryDirectory() as tmp:
+		tmp = Path(tmp)
+		
+		copies: List[Tuple[float, float, Path]] = []
+		encodes: List[Tuple[float, float, Path]] = []
+		for n, c in enumerate(cuts):
+			keyframe = _previous_keyframe(keyframes, c.start)
+			if keyframe is not None and c.start - keyframe <= MAX_LEAD_IN and keyframe < c.end:
+				copies.append((max(c.start, keyframe), c.end, tmp / f'{n}.mp4'))
+			else:
+				encodes.append((c.start, c.end, tmp / f'{n}.mp4'))
+		logger.info(f'Cutting {len(cuts)} clips: {len(copies)} copied, {len(encodes)} re-encoded.')
+		
+		failed = set()
+		for outputs, copy, size in (copies, True, BATCH_SIZE), (encodes, False, ENCODE_BATCH_SIZE):
+			for i in range(0, len(outputs), size):
+				batch = outputs[i:i + size]
+				try:
+					_pass(source, batch, copy)
+				except IOError:
+					logger.warning('Cutting pass failed, cutting clips one by one.')
+					for output in batch:
+						try:
+							_pass(source, [output], copy)
+						except IOError:
+							failed.add(output[2])
+		
+		errors = []
+		for n, c in enumerate(cuts):
+			path = tmp / f'{n}.mp4'
+			if path in failed:
+				errors.append(c)
+				continue
+			
+			path.replace(c.path)
+	
+	return errors
+
+
+def _previous_keyframe(keyframes: Sequence[float], t: float) -> Optional[float]:
+	"""Finds the last keyframe at or before a given time (or just after it, within the tolerance)."""
+	i = bisect.bisect_right(keyframes, t + KEYFRAME_TOLERANCE)
+	return keyframes[i - 1] if i > 0 else None
+
+
+def _pass(source: PathLike, outputs: Sequence[Tuple[float, float, Path]], copy: bool) -> None:
+	"""
+	Writes several parts of a video in a single ffmpeg pass over it.
+	
+	:param source: path to the video file
+	:param outputs: start time, end time and output path for each part
+	:param copy: whether to copy the parts' streams (from the keyframe before their start) or re-encode them
+	"""
+	if copy:
+		# every part has its own input, seeked to its start (which starts reading at the keyframe before it),
+		# so the packets before its start are kept and the muxer hides them with an edit list
+		args = []
+		for start, _, _ in outputs:
+			args += ['-ss', f'{start:.3f}', '-i', str(source)]
+		for i, (start, end, path) in enumerate(outputs):
+			args += ['-map', str(i), '-t', f'{end - start:.3f}', '-c', 'copy', str(path)]
+	else:
+		args = ['-i', str(source)]
+		for start, end, path in outputs:
+			args += [
+				'-ss', f'{start:.3f}', '-to', f'{end:.3f}',
+				'-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-c:a', 'aac', str(path),
+			]
+	
+	ffmpeg.run(*args)
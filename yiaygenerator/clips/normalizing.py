@@ -0,0 +1,76 @@
+"""
+Transcodes the clips to a single encoding profile.
+
+The source videos vary in resolution, frame rate and encoding,
+so the final render can only join clips without re-encoding them
+if they were all normalized to the same profile first.
+
+Each clip also gets a low resolution proxy in the same pass, for rendering previews quickly.
+"""
+
+from typing import Iterable, Optional
+
+from .. import ffmpeg
+from . import catalogue
+from .profiles import Profile, PROFILE, PREVIEW
+from ._logging import logger
+
+from os import PathLike
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+normalized_path = Path('expr/normalized/')
+proxies_path = Path('expr/proxies/')
+
+
+def normalize(clips: Iterable[catalogue.Clip], jobs: int = 4) -> None:
+	"""
+	Normalizes clips to the house profile and makes their proxies, and records it in the clip catalogue.
+	Clips that are already normalized to the profiles, and weren't changed since, are skipped.
+	
+	:param clips: the clips to normalize
+	:param jobs: the number of clips to transcode at once
+	"""
+	todo = [
+		c for c in clips
+		if c.profile != PROFILE.name or c.proxy_profile != PREVIEW.name or c.stamp != _stamp(c.path)
+	]
+	if not todo:
+		return
+	
+	logger.info(f'Normalizing {len(todo)} clips to {PROFILE.name}...')
+	with ThreadPoolExecutor(jobs) as pool:  # the work is done by ffmpeg processes anyway
+		normalized = [c for c in pool.map(_normalize, todo) if c is not None]
+	
+	catalogue.add(normalized)
+
+
+def normalize_all(jobs: int = 4) -> None:
+	"""Normalizes every clip in the catalogue that isn't up to date."""
+	normalize(catalogue.all_clips(), jobs)
+
+
+def _normalize(clip: catalogue.Clip) -> Optional[catalogue.Clip]:
+	"""Transcodes a single clip (decoding it once for both profiles), and returns its updated catalogue entry."""
+	path = normalized_path / clip.path.parent.name / clip.path.name
+	proxy = proxies_path / clip.path.parent.name / clip.path.name
+	path.parent.mkdir(parents=True, exist_ok=True)
+	proxy.parent.mkdir(parents=True, exist_ok=True)
+	
+	stamp = _stamp(clip.path)
+	try:
+		ffmpeg.run('-i', str(clip.path), *PROFILE.args(), str(path), *PREVIEW.args(), str(proxy))
+	except IOError:
+		logger.warning(f'Failed to normalize {clip.path}')
+		return None
+	
+	return clip._replace(
+		normalized=path, profile=PROFILE.name, stamp=stamp,
+		proxy=proxy, proxy_profile=PREVIEW.name,
+	)
+
+
+def _stamp(path: PathLike) -> str:
+	"""Identifies the current state of a clip file."""
+	stat = Path(path).stat()
+	return f'{stat.st_mtime_ns}-{stat.st_size}'
@@ -7,107 +7,370 @@ in order to capture the common phases of a YIAY video
 (intro, outro, etc.)
 """
 
-from typing import Sequence, Iterable
+from typing import Sequence, Iterable, NamedTuple, Pattern, List, Dict, Tuple, Optional
 
 from . import stt
 from .stt import Timestamp
 from ._logging import logger
 
 import re
+import sys
+import json
+import time
+import bisect
+import hashlib
 import collections
+from os import PathLike
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+results_path = Path('expr/parsing/')
+MATCHER_VERSION = 2
+"""Changes whenever match_pattern does, so the cached test results are matched again."""
+
+
+class Group(NamedTuple):
+	"""
+	A part of a YIAY video to capture.
+	
+	The skipped text before the group (if any) is at least one word long,
+	just like the lazy/greedy wildcards the patterns used to have.
+	The regex is only ever matched at word starts, and is bounded (no unbounded wildcards),
+	so matching a whole transcript takes linear time no matter what Jack says.
+	"""
+	name: str
+	regex: Optional[Pattern]
+	find: str
+	"""
+	How to find the group:
+		'prefix' - from the start of the text to the end of the first match
+		'first' - the first match
+		'last' - the last match
+		'rest' - the rest of the text, directly after the previous group
+	"""
+	optional: bool = False
+
 
 # Turns out there's a limit to what a single RegEx can do (who knew?).
 # So I'll be using a bunch of different patterns as fallback to each other.
 # Good idea right?
 patterns = [
-	re.compile(
-		r'(?P<INTRO>.*? asked you )?'
-		r'.*? '
-		r'(?P<START>here .{,50}?answers )'  # breaks a lot (he sometimes says "let's go" or other random stuff)
-		r'.* '
+	(
+		Group('INTRO', re.compile(r'asked you '), 'prefix', optional=True),
+		Group('START', re.compile(r'here .{,50}?answers '), 'first'),  # breaks a lot (he sometimes says "let's go" or other random stuff)
 		# TODO: sponsor
-		r'(?P<OUTRO>(leave|let) .*? YIAY )'
-		# r'(?P<END>.*? episode )'  # TODO: add the user's previous clip?
-		r'(?P<END>.*)'
+		Group('OUTRO', re.compile(r'(leave|let) .{,200}? YIAY '), 'last'),
+		# Group('END', re.compile(r'.{,200}? episode '), 'first'),  # TODO: add the user's previous clip?
+		Group('END', None, 'rest'),
 	),
-	re.compile(
-		r'(?P<INTRO>.*? asked you )?'
-		r'.* '
-		r'(?P<OUTRO>(leave|let) .*? YIAY )'
-		r'(?P<END>.*)'
+	(
+		Group('INTRO', re.compile(r'asked you '), 'prefix', optional=True),
+		Group('OUTRO', re.compile(r'(leave|let) .{,200}? YIAY '), 'last'),
+		Group('END', None, 'rest'),
 	),
 ]
 
+Span = Tuple[int, int]
 
-def parse(text: str, timestamps: Sequence[Timestamp]) -> bool:
+
+def parse(text: str, timestamps: Sequence[Timestamp]) -> Optional[List[Timestamp]]:
 	"""
 	Tries to detect parts of the video that are typical	for a YIAY video.
 	Groups the detected parts into single clips in the timestamp list.
-
+	
 	:param text: the video's full transcript to be matched against a RegEx pattern
-	:param timestamps: the timestamps list to be modified
-	:return: true if the match succeeded
+	:param timestamps: the timestamps list
+	:return: the grouped timestamps list, or None if the match failed
 	"""
-	for pattern in patterns:
-		match = pattern.fullmatch(text)
-		if match is not None:
-			break
-	else:
+	starts = _word_starts(text)
+	if len(starts) != len(timestamps):
+		logger.error(f'Transcript has {len(starts)} words but {len(timestamps)} timestamps.')
+		return None
+	
+	spans = match(text, starts)
+	if spans is None:
 		logger.error('RegEx match failed.')
-		return False
+		return None
 	
-	diff = 0
-	for group, sub in match.groupdict().items():
-		if not sub:  # empty or None
-			logger.warning(f'Group %{group} was not captured.')
-			continue
-		
-		# replaces all timestamps in the span with a single timestamp
-		count = sub.count(' ')
-		start = text[:match.start(group)].count(' ') - diff
-		end = start + count
+	# replaces all timestamps in each span with a single timestamp, in a single pass
+	grouped = []
+	prev = 0
+	for group, (start, end) in spans.items():
+		first = bisect.bisect_left(starts, start)
+		last = bisect.bisect_left(starts, end)
 		
-		timestamps[start:end] = [Timestamp(
+		grouped.extend(timestamps[prev:first])
+		grouped.append(Timestamp(
 			f'%{group}',
-			timestamps[start].start,
-			timestamps[end - 1].end
-		)]
-		diff += count - 1  # the difference in word count
+			timestamps[first].start,
+			timestamps[last - 1].end
+		))
+		prev = last
 	
-	return True
+	grouped.extend(timestamps[prev:])
+	return grouped
 
 
-def test(inds: Iterable[int]) -> None:
+def match(text: str, starts: Optional[Sequence[int]] = None) -> Optional[Dict[str, Span]]:
 	"""
-	Tests the RegEx pattern against a range of YIAY videos.
+	Matches a transcript against the patterns, in order.
+	
+	:param text: the video's full transcript
+	:param starts: the offsets of the words in the transcript, if they were already computed
+	:return: the character span of each captured group, in order, or None if no pattern matched
+	"""
+	if starts is None:
+		starts = _word_starts(text)
+	
+	for pattern in patterns:
+		spans = match_pattern(pattern, text, starts)
+		if spans is not None:
+			for group in pattern:
+				if group.name not in spans:
+					logger.warning(f'Group %{group.name} was not captured.')
+			return spans
+	
+	return None
 
-	:param inds: indexes of videos to test
+
+def match_pattern(pattern: Sequence[Group], text: str, starts: Sequence[int]) -> Optional[Dict[str, Span]]:
+	"""
+	Matches a transcript against a single pattern.
+	Like an optional group of a regex, an optional group that matched
+	is left out again if the groups after it fail to match.
+	(A later match of it wouldn't help, since the groups after it could only match less of the text.)
+	
+	:param pattern: the groups to find, in order
+	:param text: the video's full transcript
+	:param starts: the offsets of the words in the transcript
+	:return: the character span of each captured group, in order, or None if the match failed
 	"""
-	groups = collections.Counter()
-	matched = 0
-	total = 0
+	return _match_groups(pattern, text, starts, 0)
+
+
+def _match_groups(groups: Sequence[Group], text: str, starts: Sequence[int], pos: int) -> Optional[Dict[str, Span]]:
+	"""Matches groups, in order, from a position in a transcript (see match_pattern)."""
+	if not groups:
+		return {}
+	
+	group, rest = groups[0], groups[1:]
+	if group.find == 'rest':
+		spans = _match_groups(rest, text, starts, len(text))
+		if spans is not None and pos < len(text):
+			spans = {group.name: (pos, len(text)), **spans}
+		return spans
+	
+	span = _find(group, text, starts, pos)
+	if span is not None:
+		spans = _match_groups(rest, text, starts, span[1])
+		if spans is not None:
+			return {group.name: span, **spans}
+	
+	if group.optional:  # try again without it
+		return _match_groups(rest, text, starts, pos)
+	return None
+
+
+def _find(group: Group, text: str, starts: Sequence[int], pos: int) -> Optional[Span]:
+	"""Finds a group after a position in a transcript."""
+	# groups can only start after at least one skipped word
+	candidates = range(bisect.bisect_right(starts, pos), len(starts))
+	if group.find == 'last':
+		candidates = reversed(candidates)
+	
+	for n in candidates:
+		m = group.regex.match(text, starts[n])
+		if m is not None:
+			return (0 if group.find == 'prefix' else m.start()), m.end()
+	
+	return None
+
+
+def _word_starts(text: str) -> List[int]:
+	"""Maps word indexes to character offsets in a transcript (which ends with a space)."""
+	return [0] + [m.end() for m in re.finditer(' ', text[:-1])]
+
+
+def benchmark(inds: Iterable[int], worst_case_sizes: Sequence[int] = (1000, 10000, 100000)) -> None:
+	"""
+	Times the parsing of a range of YIAY videos,
+	and of synthetic worst case transcripts (to show that the time stays linear in their length).
+	
+	:param inds: indexes of videos to parse
+	:param worst_case_sizes: word counts of the worst case transcripts to parse
+	"""
+	times = []
+	words = 0
 	for i in inds:
 		logger.ind = i
-		total += 1
+		_, text, timestamps = stt.speech_to_text(i)
 		
-		text = stt.speech_to_text(i)[1]
+		start = time.perf_counter()
+		parse(text, timestamps)
+		times.append((time.perf_counter() - start, i))
+		words += len(timestamps)
+	
+	if times:
+		total = sum(t for t, _ in times)
+		slowest, slowest_ind = max(times)
+		print(f'Parsed {len(times)} videos ({words} words) in {total:.3f}s.')
+		print(f'Average: {1000 * total / len(times):.2f}ms, slowest: {1000 * slowest:.2f}ms (YIAY#{slowest_ind:03d}).')
+	
+	for size in worst_case_sizes:
+		text, timestamps = _worst_case(size)
+		start = time.perf_counter()
+		parse(text, timestamps)
+		elapsed = time.perf_counter() - start
+		print(f'Worst case of {size} words: {1000 * elapsed:.2f}ms ({1e6 * elapsed / size:.2f}us per word).')
+
+
+def _worst_case(size: int) -> Tuple[str, List[Timestamp]]:
+	"""
+	Makes up a transcript that makes every group search the whole text:
+	"asked you" over and over (so the optional intro matches and is retried without),
+	and outro phrases that are never finished (there's no "YIAY" or "answers" to end them).
+	
+	:param size: the number of words in the transcript
+	:return: the transcript and its timestamps
+	"""
+	phrase = 'asked you here leave let me know in the comments'.split()
+	words = [phrase[n % len(phrase)] for n in range(size)]
+	return ''.join(f'{word} ' for word in words), [Timestamp(word, n / 2, n / 2 + 0.4) for n, word in enumerate(words)]
+
+
+def test(inds: Iterable[int], jobs: Optional[int] = None, output: Optional[PathLike] = None) -> Dict:
+	"""
+	Tests the RegEx patterns against a range of YIAY videos.
+	Videos are matched in parallel, and the results of each pattern are cached by its hash,
+	so only new or changed patterns are matched again.
+	
+	The report (also written as JSON to the output, or stdout) contains:
+		- per pattern: match count, matching time and coverage of each group
+		- per video: the pattern that matched it (the first one, like parse) and its groups
+		- the videos whose results changed since the previous run
+	
+	:param inds: indexes of videos to test
+	:param jobs: the number of processes to use (defaults to the number of cores)
+	:param output: path to write the report to
+	:return: the report
+	"""
+	inds = list(inds)
+	hashes = [pattern_hash(p) for p in patterns]
+	results_path.mkdir(parents=True, exist_ok=True)
+	
+	cached = {}
+	for h in hashes:
+		path = results_path / f'{h}.json'
+		if path.exists():
+			with open(path) as file:
+				cached[h] = {int(i): result for i, result in json.load(file).items()}
+		else:
+			cached[h] = {}
+	
+	todo = [(i, [n for n, h in enumerate(hashes) if i not in cached[h]]) for i in inds]
+	todo = [(i, ns) for i, ns in todo if ns]
+	logger.info(f'Matching {len(todo)} videos ({len(inds) - len(todo)} cached)...')
+	
+	with ProcessPoolExecutor(jobs) as pool:
+		for i, results in pool.map(_test_video, *zip(*todo)) if todo else ():
+			for n, result in results.items():
+				cached[hashes[n]][i] = result
+	
+	for h in hashes:
+		with open(results_path / f'{h}.json', 'w') as file:
+			json.dump(cached[h], file, separators=(',', ':'))
+	
+	report = _report(inds, hashes, cached)
+	
+	last_path = results_path / 'last.json'
+	if last_path.exists():
+		with open(last_path) as file:
+			last = {int(i): video for i, video in json.load(file)['videos'].items()}
+		report['diff'] = {
+			i: {'before': last.get(i), 'after': video}
+			for i, video in report['videos'].items() if last.get(i) != video
+		}
+	else:
+		report['diff'] = {}
+	
+	with open(last_path, 'w') as file:
+		json.dump(report, file, separators=(',', ':'))
+	
+	if output is None:
+		json.dump(report, sys.stdout, indent='\t')
+	else:
+		with open(output, 'w') as file:
+			json.dump(report, file, indent='\t')
+	
+	return report
+
+
+def pattern_hash(pattern: Sequence[Group]) -> str:
+	"""Hashes everything that affects a pattern's results."""
+	return hashlib.sha1(repr([MATCHER_VERSION] + [
+		(g.name, g.regex and g.regex.pattern, g.regex and g.regex.flags, g.find, g.optional)
+		for g in pattern
+	]).encode()).hexdigest()[:16]
+
+
+def _test_video(i: int, ns: Sequence[int]) -> Tuple[int, Dict[int, Dict]]:
+	"""
+	Matches a single video against some of the patterns (in a worker process).
+	
+	:param i: the video's index
+	:param ns: indexes of the patterns to match
+	:return: the video's index, and the result of each pattern
+	"""
+	logger.ind = i
+	text = stt.speech_to_text(i)[1]
+	starts = _word_starts(text)
+	
+	results = {}
+	for n in ns:
+		began = time.perf_counter()
+		spans = match_pattern(patterns[n], text, starts)
+		elapsed = time.perf_counter() - began
 		
-		for pattern in patterns:
-			match = pattern.fullmatch(text)
-			if match is not None:
+		results[n] = {
+			'matched': spans is not None,
+			'time': elapsed,
+			'groups': {name: (end - start) / len(text) for name, (start, end) in (spans or {}).items()},
+		}
+	
+	return i, results
+
+
+def _report(inds: Sequence[int], hashes: Sequence[str], cached: Dict[str, Dict[int, Dict]]) -> Dict:
+	"""Summarizes the results of the patterns over a range of videos."""
+	report = {'total': len(inds), 'matched': 0, 'patterns': [], 'videos': {}}
+	
+	for h in hashes:
+		results = [cached[h][i] for i in inds]
+		matched = [r for r in results if r['matched']]
+		
+		coverage = collections.defaultdict(list)
+		for r in matched:
+			for name, part in r['groups'].items():
+				coverage[name].append(part)
+		
+		report['patterns'].append({
+			'hash': h,
+			'matched': len(matched),
+			'time': sum(r['time'] for r in results),
+			'max_time': max((r['time'] for r in results), default=0.0),
+			'groups': {
+				name: {'captured': len(parts), 'coverage': sum(parts) / len(parts)}
+				for name, parts in coverage.items()
+			},
+		})
+	
+	for i in inds:
+		for n, h in enumerate(hashes):
+			if cached[h][i]['matched']:
+				report['matched'] += 1
+				report['videos'][i] = {'pattern': n, 'groups': cached[h][i]['groups']}
 				break
 		else:
-			logger.error('RegEx match failed.')
-			continue
-		
-		matched += 1
-		for name, part in match.groupdict().items():
-			if not part:
-				logger.warning(f'Group %{name} was not captured.')
-				continue
-			groups[name] += 1
-			logger.info(f'Group %{name}: {100 * len(part) / len(text):.2f}% of video.')
-	
-	print(f'Matched {matched}/{total} ({100 * matched / total:.2f}%) videos.')
-	for name, count in groups.items():
-		print(f'Group %{name}: {count}/{matched} ({100 * count / matched:.2f}%) videos.')
+			report['videos'][i] = {'pattern': None, 'groups': {}}
+	
+	return report
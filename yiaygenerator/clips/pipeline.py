@@ -0,0 +1,111 @@
+"""
+Runs work as a pipeline of stages,
+so that network-bound and CPU-bound steps on different items overlap.
+
+Each stage has its own worker threads,
+and the bounded queues between the stages apply backpressure:
+a stage that gets ahead of the next one blocks until there's room.
+"""
+
+from typing import NamedTuple, Callable, Any, Optional, Iterable, Sequence
+
+from ._logging import logger
+
+import queue
+import threading
+
+
+class Stop(Exception):
+	"""Raised by a stage to stop feeding new items into the pipeline."""
+
+
+class Stage(NamedTuple):
+	"""A single step of the pipeline."""
+	name: str
+	func: Callable[[Any], Optional[Any]]
+	"""Processes an item and returns the item for the next stage, or None to drop it."""
+	workers: int = 1
+	"""The maximum number of items processed at once."""
+	queue_size: int = 1
+	"""The maximum number of items waiting for this stage."""
+
+
+_DONE = object()
+
+
+def run(items: Iterable, stages: Sequence[Stage]) -> None:
+	"""
+	Feeds items through a pipeline of stages,
+	and waits for all of them to be processed.
+	A failing item is logged and dropped without stopping the others.
+	
+	:param items: inputs for the first stage
+	:param stages: the stages, in order
+	"""
+	stop = threading.Event()
+	queues = [queue.Queue(stage.queue_size) for stage in stages]
+	threads = []
+	
+	for n, stage in enumerate(stages):
+		outbox = queues[n + 1] if n + 1 < len(stages) else None
+		next_workers = stages[n + 1].workers if outbox else 0
+		remaining = _Countdown(stage.workers)
+		
+		for _ in range(stage.workers):
+			thread = threading.Thread(
+				target=_work, name=f'{stage.name}-{len(threads)}', daemon=True,
+				args=(stage, queues[n], outbox, next_workers, remaining, stop),
+			)
+			thread.start()
+			threads.append(thread)
+	
+	for item in items:
+		if stop.is_set():
+			break
+		queues[0].put(item)
+	
+	for _ in range(stages[0].workers):
+		queues[0].put(_DONE)
+	for thread in threads:
+		thread.join()
+
+
+class _Countdown:
+	"""Counts the workers of a stage that are still running."""
+	def __init__(self, count: int) -> None:
+		self._count = count
+		self._lock = threading.Lock()
+	
+	def done(self) -> bool:
+		"""Marks a worker as done, and returns True if it was the last one."""
+		with self._lock:
+			self._count -= 1
+			return self._count == 0
+
+
+def _work(
+		stage: Stage, inbox: queue.Queue, outbox: Optional[queue.Queue],
+		next_workers: int, remaining: _Countdown, stop: threading.Event
+) -> None:
+	"""Runs a single worker of a stage until its inbox runs out."""
+	while True:
+		item = inbox.get()
+		if item is _DONE:
+			break
+		
+		try:
+			result = stage.func(item)
+		except Stop:
+			stop.set()
+			continue
+		except Exception:
+			logger.exception(f'Stage {stage.name} failed.')
+			continue
+		
+		if result is not None and outbox is not None:
+			outbox.put(result)
+	
+	# the last worker of the stage tells the next stage there's nothing left
+	if remaining.done():
+		for _ in range(next_workers):
+			outbox.put(_DONE)
@@ -0,0 +1,62 @@
+"""
+The encoding profiles clips are normalized to (see the normalizing module).
+
+They're kept apart from the normalizing module, which needs the catalogue,
+so the catalogue can check which clips are up to date without importing it.
+"""
+
+from typing import NamedTuple, Tuple, List
+
+
+class Profile(NamedTuple):
+	"""An encoding profile for clips."""
+	codec: str = 'libx264'
+	fps: int = 30
+	size: Tuple[int, int] = (1280, 720)
+	gop: int = 60
+	"""Maximum number of frames between keyframes."""
+	preset: str = 'medium'
+	"""
+	The x264 preset, which also decides the parameter sets (CABAC, B-frames, etc.),
+	so everything that is joined to the clips has to be encoded with the same one.
+	"""
+	audio_codec: str = 'aac'
+	audio_fps: int = 44100
+	audio_channels: int = 2
+	
+	@property
+	def name(self) -> str:
+		"""A short name that changes whenever the profile does."""
+		# medium is x264's default, which clips were encoded with before the preset was a setting
+		preset = '' if self.preset == 'medium' else f'{self.preset}-'
+		return (
+			f'{self.codec}-{self.fps}fps-{self.size[0]}x{self.size[1]}-g{self.gop}-{preset}'
+			f'{self.audio_codec}-{self.audio_fps}x{self.audio_channels}'
+		)
+	
+	def video_args(self) -> List[str]:
+		"""ffmpeg output arguments for the video stream (besides scaling)."""
+		return [
+			'-c:v', self.codec, '-pix_fmt', 'yuv420p', '-profile:v', 'high', '-preset', self.preset,
+			'-r', str(self.fps), '-g', str(self.gop),
+		]
+	
+	def args(self) -> List[str]:
+		"""ffmpeg output arguments for encoding a clip to the profile."""
+		width, height = self.size
+		return [
+			'-vf', (
+				f'scale={width}:{height}:force_original_aspect_ratio=decrease,'
+				f'pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1'
+			),
+			*self.video_args(),
+			'-force_key_frames', 'expr:eq(n,0)',  # so every clip can be cut/joined at its start
+			'-c:a', self.audio_codec, '-ar', str(self.audio_fps), '-ac', str(self.audio_channels),
+			'-movflags', '+faststart',
+		]
+
+
+PROFILE = Profile()
+"""The house profile all clips are normalized to."""
+PREVIEW = Profile(fps=15, size=(640, 360), gop=30, preset='ultrafast', audio_fps=22050, audio_channels=1)
+"""The profile of the proxies (and of the segments of previews, which are joined to them)."""
@@ -5,13 +5,14 @@ What it does:
 	-
 	- Adds my avatar and a URL to the video's end card
 	- Writes each word or part to a separate video file
+	  (copied without re-encoding when it starts shortly after a keyframe, see the cutting module)
 """
 
-from typing import NewType, Dict, Set, Sequence
+from typing import Sequence, Tuple, List, BinaryIO, Optional
 
-from .. import homophones
-from . import youtube, stt, parsing
-from .stt import Timestamp, json_path
+from .. import homophones, ffmpeg
+from . import youtube, stt, parsing, cutting, catalogue, normalizing, pipeline, transcripts
+from .transcripts import Timestamp
 from ._logging import logger
 
 import moviepy.video as mpy
@@ -21,27 +22,42 @@ import moviepy.video.tools.drawing
 import moviepy.video.fx.resize
 from moviepy.video.compositing.CompositeVideoClip import CompositeVideoClip
 import youtube_dl
-from django.core.cache import cache
 
-import json
 from os import PathLike
 from pathlib import Path
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 clips_path = Path('expr/clips/')
 
 
-def make_all() -> None:
-	"""Makes video clips from all YIAY videos."""
-	i = 1
-	while True:
-		try:
-			make_from(i)
-		except IndexError:
-			break
-		i += 1
+def make_all(jobs: int = 1) -> None:
+	"""
+	Makes video clips from all YIAY videos.
+	Videos that were already clipped are skipped,
+	and a failing video doesn't stop the others.
+	
+	:param jobs: the number of videos to process in parallel
+	"""
+	todo = [e.index for e in youtube.playlist(refresh=True) if not stt.is_clipped(e.index)]
+	logger.info(f'Making clips from {len(todo)} videos...')
+	
+	with ProcessPoolExecutor(jobs) as pool:
+		for _ in pool.map(_try_make_from, todo):
+			pass
+
+
+def _try_make_from(i: int) -> None:
+	"""
+	Runs make_from in a worker process, without letting exceptions escape.
 	
-	cache.set('clips', {p.name: set(p.iterdir()) for p in clips_path.iterdir()})
+	:param i: the video's index in the playlist
+	"""
+	try:
+		make_from(i)
+	except Exception:
+		logger.ind = i
+		logger.exception('Failed to make clips.')
 
 
 def make_from(i: int) -> None:
@@ -51,78 +67,165 @@ def make_from(i: int) -> None:
 	:param i: the video's index in the playlist
 	"""
 	logger.ind = i
+	if stt.is_clipped(i):  # don't download videos that are already done
+		return
+	
 	try:
-		clipped, text, timestamps = stt.speech_to_text(i)
-		
-		if not clipped and parsing.parse(text, timestamps):  # don't use videos that don't match
-			_write(i, timestamps)
+		with youtube.video(i) as video:
+			clipped, text, timestamps = stt.speech_to_text(i, video)
+			if clipped:
+				return
+			
+			timestamps = parsing.parse(text, timestamps)
+			if timestamps is not None:  # don't use videos that don't match
+				_write(i, timestamps, video)
 	
 	except youtube_dl.DownloadError:
 		logger.error('Youtube failed to provide video')
 
 
-ClipList = NewType('ClipList', Dict[str, Set[PathLike]])
+def make_all_pipelined(
+		stt_jobs: int = 2, download_jobs: int = 2, write_jobs: int = 1, queue_size: int = 2
+) -> None:
+	"""
+	Makes video clips from all YIAY videos,
+	running the download, transcript and writing steps of different videos at the same time.
+	
+	:param stt_jobs: the number of videos to transcribe at once
+	:param download_jobs: the number of videos to download at once
+	:param write_jobs: the number of videos to write clips from at once
+	:param queue_size:
+		the number of videos that may wait between two steps
+		(downloaded videos are kept in the cache directory, so it doesn't bound the disk space they take)
+	"""
+	pipeline.run(range(1, len(youtube.playlist(refresh=True)) + 1), [
+		pipeline.Stage('download', _download, download_jobs, queue_size),
+		pipeline.Stage('stt', _transcribe, stt_jobs, queue_size),
+		pipeline.Stage('write', _write_downloaded, write_jobs, queue_size),
+	])
+
+
+def _download(i: int) -> Optional[Tuple[int, BinaryIO]]:
+	"""Pipeline stage: downloads a video, if it wasn't clipped yet."""
+	logger.ind = i
+	if stt.is_clipped(i):
+		return None
+	
+	try:
+		return i, youtube.video(i)
+	except IndexError:
+		raise pipeline.Stop
+	except youtube_dl.DownloadError:
+		logger.error('Youtube failed to provide video')
+		return None
+
+
+def _transcribe(job: Tuple[int, BinaryIO]) -> Optional[Tuple[int, List[Timestamp], BinaryIO]]:
+	"""Pipeline stage: gets and parses the transcript of a downloaded video."""
+	i, video = job
+	logger.ind = i
+	try:
+		clipped, text, timestamps = stt.speech_to_text(i, video)
+		timestamps = None if clipped else parsing.parse(text, timestamps)
+		if timestamps is not None:
+			return i, timestamps, video
+	except BaseException:
+		video.close()
+		raise
+	
+	video.close()
+	return None
+
+
+def _write_downloaded(job: Tuple[int, List[Timestamp], BinaryIO]) -> None:
+	"""Pipeline stage: writes clips from a downloaded video."""
+	i, timestamps, video = job
+	logger.ind = i
+	with video:
+		_write(i, timestamps, video)
+
+
+ClipList = catalogue.Catalogue
+
+_clip_list: Optional[ClipList] = None
 
 
 def get_list() -> ClipList:
 	"""
-	Returns a dict mapping words to paths
-	to the available clips.
+	Returns the available clips.
+	The catalogue is loaded once per process, and reloaded whenever the clip index changes.
 	"""
-	return cache.get_or_set(
-		'clips', lambda: {p.name: set(p.iterdir()) for p in clips_path.iterdir()}
-	)
+	global _clip_list
+	if _clip_list is None or _clip_list.version != catalogue.version():
+		_clip_list = catalogue.load()
+	return _clip_list
 
 
-def _write(i: int, timestamps: Sequence[Timestamp]) -> None:
+def _write(i: int, timestamps: Sequence[Timestamp], video: BinaryIO) -> None:
 	"""
 	Writes clips from a YIAY video using a list of timestamps.
 	
 	:param i: the video's index
 	:param timestamps: the timestamps list
+	:param video: the downloaded video file
 	"""
 	word_count = Counter()
+	cuts = []
+	written = []
 	
-	with youtube.video(i, only_audio=False) as video:
-		with mpy.io.VideoFileClip.VideoFileClip(video.name) as clip:
-			
-			logger.info(f'Writing {len(timestamps)} clips...')
-			for word, start, end in timestamps:
-				logger.debug(f'{word}: {start:.2f} - {end:.2f}')
-				
-				dirname = clips_path / (word if word.startswith("%") else homophones.get(word))
-				if not dirname.exists():
-					dirname.mkdir()
-				
-				sub = clip.subclip(start, end)
-				if word == '%END' and i >= END_CARD_START:
-					logger.info('Applying overlay to end card.')
-					sub = mpy.compositing.CompositeVideoClip.CompositeVideoClip([
-						sub, _end_card.set_duration(sub.duration)
-					])
-				
-				try:
-					sub.write_videofile(str(dirname / f'{i:03d}-{word_count[word]:03d}.mp4'), logger=None)
-				except IOError:
-					logger.warning(f'Failed at {start:.2f}-{end:.2f}')
-				
-				word_count[word] += 1
-	
-	_set_clipped(json_path / f'{i:03d}.json', True)
-	
-
-def _set_clipped(path: PathLike, clipped: bool) -> None:
-	"""Updates a JSON file to indicate whether the video was successfully clipped."""
-	with open(path, 'r+') as file:
-		data = json.load(file)
-		file.seek(0)
-		file.truncate()
-		json.dump({**data, 'clipped': clipped}, file, separators=(',', ':'))
+	info = ffmpeg.info(video.name)
+	
+	logger.info(f'Writing {len(timestamps)} clips...')
+	for word, start, end in timestamps:
+		logger.debug(f'{word}: {start:.2f} - {end:.2f}')
+		
+		word = word if word.startswith("%") else homophones.get(word)
+		dirname = clips_path / word
+		dirname.mkdir(exist_ok=True)  # might be created by another thread at the same time
+		
+		clip = catalogue.Clip(
+			word, i, start, end, end - start,
+			info.width, info.height, dirname / f'{i:03d}-{word_count[word]:03d}.mp4',
+		)
+		word_count[word] += 1
+		
+		if word == '%END' and i >= END_CARD_START:
+			if _write_end_card(video.name, clip):
+				written.append(clip)
+		else:
+			cuts.append(clip)
+	
+	failed = cutting.cut(video.name, [cutting.Cut(c.start, c.end, c.path) for c in cuts])
+	for c in failed:
+		logger.warning(f'Failed at {c.start:.2f}-{c.end:.2f}')
+	
+	failed = {c.path for c in failed}
+	written.extend(c for c in cuts if c.path not in failed)
+	
+	catalogue.add(written)
+	normalizing.normalize(written)
+	transcripts.set_clipped(i, True)
+
 
+def _write_end_card(source: PathLike, clip: catalogue.Clip) -> bool:
+	"""Writes the end card clip, which has to be re-encoded to apply the overlay."""
+	logger.info('Applying overlay to end card.')
+	with mpy.io.VideoFileClip.VideoFileClip(str(source)) as video:
+		sub = video.subclip(clip.start, clip.end)
+		try:
+			CompositeVideoClip([
+				sub, _end_card.set_duration(sub.duration)
+			]).write_videofile(str(clip.path), logger=None)
+		except IOError:
+			logger.warning(f'Failed at {clip.start:.2f}-{clip.end:.2f}')
+			return False
+	
+	return True
+	
 
 AVATAR_URL = 'https://avatars0.githubusercontent.com/u/39616775?v=4'
 END_CARD_START = 379
-CLIP_SIZE = 1280, 720
+CLIP_SIZE = normalizing.PROFILE.size
 BOX_SIZE = 412, 231
 TEXT_POS = 828, 361
 AVATAR_POS = 828, 101
@@ -159,10 +262,12 @@ _end_card = _build_end_card_overlay()
 
 
 def reset() -> None:
-	"""Deletes the clips and resets the 'clipped' attribute in the JSON files."""
-	for word in clips_path.iterdir():
-		for clip in word.iterdir():
-			clip.unlink()
+	"""Deletes the clips and resets the 'clipped' flags in the transcript store."""
+	for path in clips_path, normalizing.normalized_path, normalizing.proxies_path:
+		for word in path.iterdir():
+			for clip in word.iterdir():
+				clip.unlink()
+	catalogue.clear()
 	
-	for path in json_path.iterdir():
-		_set_clipped(path, False)
+	for i in transcripts.episodes():
+		transcripts.set_clipped(i, False)
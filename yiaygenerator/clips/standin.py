@@ -0,0 +1,226 @@
+"""
+A local stand-in for the speech-to-text API,
+for checking the chunked transcription (chunking, merging and retries) without the real service.
+
+It speaks the recognize response schema, but it only "recognizes" beeps:
+every beep is a word named after its pitch, timed by where it is in the audio.
+The check renders a video of random beeps, transcribes it through the stand-in
+(with some requests failing on purpose), and compares the words to the beeps.
+"""
+
+from typing import List, Dict
+
+from .. import ffmpeg
+from . import stt
+from ._logging import logger
+
+import numpy as np
+
+import json
+import random
+import threading
+import subprocess
+import tempfile
+import socketserver
+import http.server
+
+SAMPLE_RATE = 16000
+PITCHES = [400 + 200 * k for k in range(10)]
+"""The pitch of each beep word, in Hz."""
+FRAME_LENGTH = 0.01
+"""The resolution of the timestamps, in seconds."""
+THRESHOLD = 0.05
+"""The volume (RMS) of a frame to count as a part of a beep."""
+TOLERANCE = 0.05
+"""How far the merged timestamps can be from the beeps, in seconds."""
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+	"""A stand-in API server that fails a number of requests before answering them."""
+	def __init__(self, failures: int = 0) -> None:
+		"""
+		:param failures: the number of requests to answer with 503 Service Unavailable
+		"""
+		super().__init__(('127.0.0.1', 0), _Handler)
+		self.daemon_threads = True
+		self.failures = failures
+		self.requests = 0
+		self.lock = threading.Lock()
+	
+	@property
+	def url(self) -> str:
+		return f'http://127.0.0.1:{self.server_port}'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+	server: Server
+	
+	def do_POST(self) -> None:
+		audio = self._body()
+		with self.server.lock:
+			self.server.requests += 1
+			fail = self.server.failures > 0
+			self.server.failures -= fail
+		
+		if fail:
+			self._send(503, {'code': 503, 'error': 'Service Unavailable'})
+			return
+		
+		timestamps = _recognize(audio)
+		self._send(200, {
+			'results': [{
+				'final': True,
+				'alternatives': [{
+					'transcript': ''.join(f'{word} ' for word, _, _ in timestamps),
+					'confidence': 1.0,
+					'timestamps': timestamps,
+				}],
+			}],
+			'result_index': 0,
+		})
+	
+	def _body(self) -> bytes:
+		"""Reads the request's body (the SDK might send it in chunks)."""
+		if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+			return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		
+		body = bytearray()
+		while True:
+			size = int(self.rfile.readline().split(b';')[0], 16)
+			body += self.rfile.read(size + 2)[:size]  # each chunk ends with a CRLF
+			if not size:
+				return bytes(body)
+	
+	def _send(self, status: int, data: Dict) -> None:
+		body = json.dumps(data).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	
+	def log_message(self, fmt: str, *args) -> None:
+		logger.debug(f'Stand-in: {fmt % args}')
+
+
+def serve(failures: int = 0) -> Server:
+	"""
+	Starts a stand-in API server in a background thread.
+	Point WATSON_URL (or the service's URL) at its url, and shut it down when done.
+	
+	:param failures: the number of requests to fail before answering them
+	:return: the running server
+	"""
+	server = Server(failures)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+
+def check(duration: float = 100.0, chunk_length: float = 30.0, failures: int = 2, seed: int = 0) -> bool:
+	"""
+	Transcribes a video of beeps in chunks through the stand-in,
+	and checks that every beep was transcribed once, in order, at the right time.
+	
+	:param duration: the length of the video, in seconds
+	:param chunk_length: the length of the chunks to send (instead of stt.CHUNK_LENGTH)
+	:param failures: the number of requests to fail on purpose, so they're retried
+	:param seed: the seed of the random beeps
+	:return: whether the transcript matched the beeps
+	"""
+	beeps = _beeps(duration, random.Random(seed))
+	server = serve(failures)
+	url, length = stt._service.url, stt.CHUNK_LENGTH
+	stt._service.set_url(server.url)
+	stt.CHUNK_LENGTH = chunk_length
+	try:
+		with tempfile.NamedTemporaryFile(suffix='.mp4') as video:
+			_video(beeps, duration, video.name)
+			_, timestamps = stt._transcribe(video.name)
+	finally:
+		stt._service.set_url(url)
+		stt.CHUNK_LENGTH = length
+		server.shutdown()
+		server.server_close()
+	
+	ok = True
+	logger.info(f'Transcribed {len(timestamps)} of {len(beeps)} beeps with {server.requests} requests.')
+	if server.failures:
+		logger.error(f'Only {failures - server.failures} of {failures} failed requests were retried.')
+		ok = False
+	
+	words, expected = [word for word, _, _ in timestamps], [word for word, _, _ in beeps]
+	if words != expected:
+		logger.error(f'The words don\'t match the beeps: {words} != {expected}')
+		return False
+	
+	error = max((abs(t[1] - b[1]) + abs(t[2] - b[2]) for t, b in zip(timestamps, beeps)), default=0.0)
+	if error > TOLERANCE:
+		logger.error(f'The timestamps are off by up to {error:.3f}s.')
+		ok = False
+	
+	return ok
+
+
+def _beeps(duration: float, rng: random.Random) -> List[List]:
+	"""Randomizes the words and timestamps of a video of beeps."""
+	beeps = []
+	t = rng.uniform(0.1, 0.4)
+	while True:
+		length = rng.uniform(0.2, 0.5)
+		if t + length > duration:
+			return beeps
+		
+		beeps.append([f'beep{rng.randrange(len(PITCHES))}', round(t, 2), round(t + length, 2)])
+		t += length + rng.uniform(0.1, 0.4)
+
+
+def _video(beeps: List[List], duration: float, path: str) -> None:
+	"""Renders a video (a black frame) with beeps for audio."""
+	samples = np.zeros(round(duration * SAMPLE_RATE), np.float32)
+	for word, start, end in beeps:
+		a, b = round(start * SAMPLE_RATE), round(end * SAMPLE_RATE)
+		pitch = PITCHES[int(word[len('beep'):])]
+		samples[a:b] = 0.5 * np.sin(2 * np.pi * pitch * np.arange(b - a) / SAMPLE_RATE)
+	
+	with tempfile.NamedTemporaryFile(suffix='.pcm') as audio:
+		audio.write((samples * 32767).astype('<i2').tobytes())
+		audio.flush()
+		ffmpeg.run(
+			'-f', 'lavfi', '-i', f'color=black:s=64x64:r=10:d={duration}',
+			'-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', '1', '-i', audio.name,
+			'-c:v', 'libx264', '-c:a', 'aac', '-b:a', '128k', '-shortest', path,
+		)
+
+
+def _recognize(audio: bytes) -> List[List]:
+	"""
+	Finds the beeps in an audio file.
+	
+	:param audio: the audio file's data
+	:return: a word and timestamps for each beep, like the API's
+	"""
+	with tempfile.NamedTemporaryFile() as file:
+		file.write(audio)
+		file.flush()
+		process = ffmpeg.popen(
+			'-i', file.name, '-f', 's16le', '-ac', '1', '-ar', str(SAMPLE_RATE), '-',
+			stdout=subprocess.PIPE,
+		)
+		data, _ = process.communicate()
+	if process.returncode:
+		raise IOError(f'Decoding the request\'s audio failed (ffmpeg exited with {process.returncode})')
+	
+	samples = np.frombuffer(data, '<i2').astype(np.float32) / 32768
+	frame = round(SAMPLE_RATE * FRAME_LENGTH)
+	count = len(samples) // frame
+	loud = np.sqrt(np.mean(samples[:count * frame].reshape(count, frame) ** 2, axis=1)) > THRESHOLD
+	edges = np.flatnonzero(np.diff(np.concatenate(([0], loud.astype(np.int8), [0]))))
+	
+	timestamps = []
+	for start, end in zip(edges[::2], edges[1::2]):
+		beep = samples[start * frame:end * frame]
+		pitch = np.argmax(np.abs(np.fft.rfft(beep))) * SAMPLE_RATE / len(beep)
+		word = f'beep{int(np.argmin([abs(pitch - p) for p in PITCHES]))}'
+		timestamps.append([word, round(start * FRAME_LENGTH, 2), round(end * FRAME_LENGTH, 2)])
+	
+	return timestamps
@@ -1,11 +1,17 @@
 """
 Fetches text-to-speech transcripts of videos
 from the IBM Watson developer cloud API.
+
+Long videos are split into overlapping chunks that are sent concurrently.
+Set WATSON_URL to point the requests at a different server
+(like a local stand-in that speaks the same recognize response schema).
 """
 
-from typing import Tuple, List, Dict, BinaryIO, NamedTuple
+from typing import Tuple, List, Dict, BinaryIO, Optional, Sequence
 
-from . import youtube
+from .. import ffmpeg
+from . import youtube, transcripts
+from .transcripts import Timestamp
 from ._logging import logger
 
 import watson_developer_cloud as watson
@@ -13,81 +19,221 @@ from watson_developer_cloud.watson_service import requests
 from watson_developer_cloud.speech_to_text_v1 import CustomWord
 
 import json
+import math
+import bisect
+import difflib
 import time
+import random
+import tempfile
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from os import environ, PathLike
 from pathlib import Path
 
 json_path = Path('expr/stt/')
+"""Where transcripts were saved before the transcript store, see transcripts.migrate."""
 model_path = Path('stt_custom/')
 
 _service = watson.SpeechToTextV1(
+	url=environ.get('WATSON_URL', watson.SpeechToTextV1.default_url),
 	username=environ['WATSON_USERNAME'],
 	password=environ['WATSON_PASSWORD']
 )
 
-
-class Timestamp(NamedTuple):
-	"""Word timestamp as received from the API."""
-	word: str
-	start: float
-	end: float
+CHUNK_LENGTH = float(environ.get('WATSON_CHUNK_LENGTH', 300))
+"""Length of the audio chunks in seconds, or 0 to send the whole audio at once."""
+CHUNK_OVERLAP = 10.0
+"""Words near a chunk's edges might be cut, so each chunk overlaps the next one by this many seconds."""
+MAX_IN_FLIGHT = int(environ.get('WATSON_MAX_IN_FLIGHT', 4))
+MAX_RETRIES = 6
+BACKOFF_CAP = 60.0
 
 
-def speech_to_text(i: int) -> Tuple[bool, str, List[Timestamp]]:
+def speech_to_text(i: int, video: Optional[BinaryIO] = None) -> Tuple[bool, str, Sequence[Timestamp]]:
 	"""
 	Loads the speech-to-text transcript for a YIAY video.
 	Makes an API request if a transcript was not found.
 	
 	:param i: the video's index in the playlist
+	:param video: the video file, if it was already downloaded
 	:return:
 		A boolean indicating whether the video was already parsed,
 		a full transcript, and timestamps for each word.
 	"""
+	_migrate(i)
+	stored = transcripts.load(i)
+	if stored is not None:
+		logger.debug('Loading transcript from the store.')
+		return stored
+	
+	if video is None:
+		with youtube.video(i) as video:
+			return (False, *_process(i, *_transcribe(video.name)))
+	
+	return (False, *_process(i, *_transcribe(video.name)))
+
+
+def is_clipped(i: int) -> bool:
+	"""
+	Checks whether a video was already clipped,
+	importing its transcript first if it wasn't migrated to the store yet,
+	so videos aren't downloaded just to find out that they're done.
+	"""
+	_migrate(i)
+	return transcripts.is_clipped(i)
+
+
+def _migrate(i: int) -> None:
+	"""Imports the transcript of a video from its JSON file, if it's not in the store yet."""
 	path = json_path / f'{i:03d}.json'
-	if path.exists():
-		logger.debug(f'Loading transcript from {path}.')
-		with open(path) as file:
-			data = json.load(file)
-		return data['clipped'], data['transcript'], [Timestamp(*s) for s in data['timestamps']]
-	else:
-		with youtube.video(i, only_audio=True) as audio:
-			return (False, *_process(path, _request(audio)))
+	if path.exists() and transcripts.load(i) is None:
+		transcripts.import_json(i, path)
+
+
+def _transcribe(video: PathLike) -> Tuple[str, List[List]]:
+	"""
+	Gets the transcript of a video from the API.
+	Long videos are sent as several chunks at once.
+	
+	:param video: path to the video file
+	:return:
+		The video's complete transcript,
+		and timestamps for each word as received from the API.
+	"""
+	duration = ffmpeg.info(video).duration
+	if not CHUNK_LENGTH or duration is None or duration <= CHUNK_LENGTH:
+		with _extract_audio(video) as audio:
+			return _collect(_request(audio))
+	
+	step = CHUNK_LENGTH - CHUNK_OVERLAP
+	offsets = [n * step for n in range(math.ceil((duration - CHUNK_LENGTH) / step) + 1)]
+	logger.info(f'Sending {len(offsets)} chunks...')
+	
+	ind = logger.ind
+	
+	def request_chunk(offset: float) -> List[List]:
+		logger.ind = ind  # new thread
+		with _extract_audio(video, offset, CHUNK_LENGTH) as audio:
+			return _collect(_request(audio))[1]
+	
+	with ThreadPoolExecutor(MAX_IN_FLIGHT) as pool:
+		chunks = list(pool.map(request_chunk, offsets))
+	
+	timestamps = _merge(offsets, chunks)
+	return ''.join(f'{word} ' for word, _, _ in timestamps), timestamps
+
+
+def _merge(offsets: List[float], chunks: List[List[List]]) -> List[List]:
+	"""
+	Merges the timestamps of overlapping chunks into a single list.
+	Every word in an overlap is taken from exactly one of the chunks (see _cut),
+	so the words line up with the transcript.
+	
+	:param offsets: the start time of each chunk
+	:param chunks: the timestamps of each chunk, relative to the chunk's start
+	:return: the timestamps of the whole audio
+	"""
+	chunks = [
+		[[word, offset + start, offset + end] for word, start, end in timestamps]
+		for offset, timestamps in zip(offsets, chunks)
+	]
+	# the range of words taken from each chunk
+	starts = [0] * len(chunks)
+	ends = [len(timestamps) for timestamps in chunks]
+	for n in range(len(chunks) - 1):
+		ends[n], starts[n + 1] = _cut(chunks[n], chunks[n + 1], offsets[n + 1], offsets[n] + CHUNK_LENGTH)
+	
+	return [word for timestamps, start, end in zip(chunks, starts, ends) for word in timestamps[start:end]]
+
+
+def _cut(first: List[List], second: List[List], start: float, end: float) -> Tuple[int, int]:
+	"""
+	Finds where to switch from a chunk to the next one.
+	The overlap is aligned by its words, and cut at the common word closest to its middle,
+	because the chunks recognize the same words with slightly different timestamps.
+	If they have no words in common, it's cut at the longest silence in the first chunk.
+	
+	:param first: the absolute timestamps of a chunk
+	:param second: the absolute timestamps of the next chunk
+	:param start: the start of the overlap
+	:param end: the end of the overlap
+	:return: the end of the words to take from the first chunk, and the start of the words to take from the second
+	"""
+	first_starts = [s for _, s, _ in first]
+	second_starts = [s for _, s, _ in second]
+	a = range(bisect.bisect_left(first_starts, start), len(first))
+	b = range(0, bisect.bisect_left(second_starts, end))
+	
+	matcher = difflib.SequenceMatcher(None, [first[i][0] for i in a], [second[j][0] for j in b], autojunk=False)
+	common = [(a[x + k], b[y + k]) for x, y, size in matcher.get_matching_blocks() for k in range(size)]
+	if common:
+		middle = (start + end) / 2
+		return min(common, key=lambda pair: abs(first[pair[0]][1] - middle))
+	
+	# the gaps between the words, including the edges of the overlap
+	times = [start, *(t for i in a for t in first[i][1:]), end]
+	gap = max(range(0, len(times), 2), key=lambda k: times[k + 1] - times[k])
+	cut = (times[gap] + times[gap + 1]) / 2
+	return bisect.bisect_left(first_starts, cut), bisect.bisect_left(second_starts, cut)
+
+
+def _extract_audio(video: PathLike, start: float = 0.0, length: Optional[float] = None) -> BinaryIO:
+	"""
+	Extracts a small audio file from a video for the API request.
+	The audio is downmixed to mono and resampled to 16kHz,
+	which is all the speech-to-text model uses anyway.
+	
+	:param video: path to the video file
+	:param start: the time to start the audio from
+	:param length: the length of the audio, or None for the rest of the video
+	:return: a temporary Opus audio file
+	"""
+	logger.info(f'Extracting audio from {start:.0f}s...')
+	audio = tempfile.NamedTemporaryFile(suffix='.ogg')
+	ffmpeg.run(
+		'-ss', f'{start:.3f}', *(('-t', f'{length:.3f}') if length else ()), '-i', str(video), '-vn',
+		'-ac', '1', '-ar', '16000',
+		'-c:a', 'libopus', '-b:a', '24k',
+		'-f', 'ogg', audio.name,
+	)
+	return audio
 
 
 def _request(stream: BinaryIO) -> Dict:
 	"""
 	Sends an audio file to the speech-to-text API,
 	and gets the results.
+	Retries with exponential backoff when the API acts weird.
 	
 	:param stream: audio file binary data
-	:return:
-		The audio's complete transcript,
-		and timestamps for each word.
+	:return: the API's response
 	"""
 	logger.info(f'Making an API request...')
-	try:
-		return _service.recognize(
-			audio=stream,
-			content_type='audio/webm',
-			language_customization_id=environ.get('WATSON_CUSTOMIZATION_ID'),  # costs money
-			timestamps=True,
-			profanity_filter=False
-		).get_result()
-	
-	except (watson.WatsonApiException, requests.exceptions.ConnectionError) as e:
-		logger.warning(f'Got the weird {e.__class__.__name__} again, retrying...')
+	for attempt in itertools.count(1):
+		try:
+			return _service.recognize(
+				audio=stream,
+				content_type='audio/ogg;codecs=opus',
+				language_customization_id=environ.get('WATSON_CUSTOMIZATION_ID'),  # costs money
+				timestamps=True,
+				profanity_filter=False
+			).get_result()
 		
-		stream.seek(0)
-		time.sleep(5)
-		return _request(stream)
+		except (watson.WatsonApiException, requests.exceptions.ConnectionError) as e:
+			if attempt == MAX_RETRIES:
+				raise
+			
+			delay = random.uniform(0.5, 1) * min(BACKOFF_CAP, 2 ** attempt)
+			logger.warning(f'Got the weird {e.__class__.__name__} again, retrying in {delay:.1f}s...')
+			
+			stream.seek(0)
+			time.sleep(delay)
 
 
-def _process(filename: PathLike, response: Dict) -> Tuple[str, List[Timestamp]]:
+def _collect(response: Dict) -> Tuple[str, List[List]]:
 	"""
-	Collects the relevant data from an API response,
-	and saves it in a JSON file.
+	Collects the relevant data from an API response.
 	
-	:param filename: path to a file to save the data in
 	:param response: the response from an API request for an audio file
 	:return:
 		The audio's complete transcript,
@@ -102,15 +248,21 @@ def _process(filename: PathLike, response: Dict) -> Tuple[str, List[Timestamp]]:
 		transcripts.append(alternative['transcript'])
 		timestamps.extend(alternative['timestamps'])
 	
-	transcript = ''.join(transcripts)
-	# save to file
-	with open(filename, 'w') as file:
-		json.dump({
-			'clipped': False,
-			'transcript': transcript,
-			'timestamps': timestamps
-		}, file, separators=(',', ':'))
+	return ''.join(transcripts), timestamps
+
+
+def _process(i: int, transcript: str, timestamps: List[List]) -> Tuple[str, List[Timestamp]]:
+	"""
+	Saves a transcript in the transcript store.
 	
+	:param i: the video's index in the playlist
+	:param transcript: the audio's complete transcript
+	:param timestamps: timestamps for each word, as received from the API
+	:return:
+		The audio's complete transcript,
+		and timestamps for each word.
+	"""
+	transcripts.save(i, transcript, timestamps)
 	return transcript, [Timestamp(*s) for s in timestamps]
 
 
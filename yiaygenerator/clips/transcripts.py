@@ -0,0 +1,237 @@
+"""
+Stores the speech-to-text transcripts of all the videos in a single binary file,
+which is memory-mapped instead of parsing a JSON file per video.
+
+File layout:
+	- header: magic, capacity, a flags byte per video and an index entry per video
+	- a block per video: float32 start times, float32 end times, transcript text, words
+Blocks are only appended, and flags are updated in place.
+"""
+
+from typing import Sequence, Tuple, List, Optional, Union, Iterator, NamedTuple
+
+from ._logging import logger
+
+import numpy as np
+
+import json
+import fcntl
+import contextlib
+from os import PathLike
+from pathlib import Path
+
+store_path = Path('expr/transcripts.bin')
+
+MAGIC = b'YIAYSTT1'
+CAPACITY = 1024
+"""Maximum number of videos in the store."""
+
+PRESENT = 1
+CLIPPED = 2
+
+_index_dtype = np.dtype([
+	('offset', '<u8'),
+	('count', '<u4'),
+	('text_size', '<u4'),
+	('words_size', '<u4'),
+	('reserved', '<u4'),
+])
+_FLAGS_OFFSET = len(MAGIC) + 8
+_INDEX_OFFSET = _FLAGS_OFFSET + CAPACITY
+_HEADER_SIZE = _INDEX_OFFSET + CAPACITY * _index_dtype.itemsize
+
+
+class Timestamp(NamedTuple):
+	"""Word timestamp as received from the API."""
+	word: str
+	start: float
+	end: float
+
+
+class Timestamps(Sequence[Timestamp]):
+	"""
+	The word timestamps of a video, backed by the store's arrays.
+	Timestamp objects are only created for the items that are accessed.
+	"""
+	def __init__(self, words: List[str], starts: np.ndarray, ends: np.ndarray) -> None:
+		self.words = words
+		self.starts = starts
+		self.ends = ends
+	
+	def __len__(self) -> int:
+		return len(self.words)
+	
+	def __getitem__(self, i: Union[int, slice]) -> Union[Timestamp, List[Timestamp]]:
+		if isinstance(i, slice):
+			return [Timestamp(*t) for t in zip(self.words[i], self.starts[i].tolist(), self.ends[i].tolist())]
+		return Timestamp(self.words[i], float(self.starts[i]), float(self.ends[i]))
+	
+	def __iter__(self) -> Iterator[Timestamp]:
+		return map(Timestamp, self.words, self.starts.tolist(), self.ends.tolist())
+
+
+def load(i: int) -> Optional[Tuple[bool, str, Timestamps]]:
+	"""
+	Loads the transcript of a video from the store.
+	
+	:param i: the video's index in the playlist
+	:return:
+		None if the video is not in the store, or:
+		a boolean indicating whether the video was already clipped,
+		a full transcript, and timestamps for each word.
+	"""
+	_check(i)
+	data = _map()
+	if data is None or not data[_FLAGS_OFFSET + i - 1] & PRESENT:
+		return None
+	
+	entry = _index(data)[i - 1]
+	offset, count = int(entry['offset']), int(entry['count'])
+	text_size, words_size = int(entry['text_size']), int(entry['words_size'])
+	
+	starts = np.frombuffer(data, '<f4', count, offset)
+	ends = np.frombuffer(data, '<f4', count, offset + 4 * count)
+	offset += 8 * count
+	text = bytes(data[offset:offset + text_size]).decode()
+	offset += text_size
+	words = bytes(data[offset:offset + words_size]).decode()
+	
+	return (
+		bool(data[_FLAGS_OFFSET + i - 1] & CLIPPED),
+		text,
+		Timestamps(words.split('\n') if count else [], starts, ends),
+	)
+
+
+def save(i: int, transcript: str, timestamps: Sequence[Sequence], clipped: bool = False) -> None:
+	"""
+	Adds the transcript of a video to the store,
+	replacing the existing one (its old block is left unused).
+	
+	:param i: the video's index in the playlist
+	:param transcript: the video's full transcript
+	:param timestamps: word, start and end for each word
+	:param clipped: whether the video was already clipped
+	"""
+	_check(i)
+	words = [word for word, _, _ in timestamps]
+	times = np.array([[start for _, start, _ in timestamps], [end for _, _, end in timestamps]], '<f4')
+	text = transcript.encode()
+	joined = '\n'.join(words).encode()
+	
+	with _locked() as file:
+		file.seek(0, 2)
+		offset = file.tell()
+		offset += -offset % 8  # keep the arrays aligned
+		
+		file.seek(offset)
+		file.write(times.tobytes())
+		file.write(text)
+		file.write(joined)
+		
+		entry = np.array([(offset, len(words), len(text), len(joined), 0)], _index_dtype)
+		file.seek(_INDEX_OFFSET + (i - 1) * _index_dtype.itemsize)
+		file.write(entry.tobytes())
+		
+		file.seek(_FLAGS_OFFSET + i - 1)
+		file.write(bytes([PRESENT | (CLIPPED if clipped else 0)]))
+
+
+def set_clipped(i: int, clipped: bool) -> None:
+	"""Updates the store in place to indicate whether the video was successfully clipped."""
+	_check(i)
+	with _locked() as file:
+		file.seek(_FLAGS_OFFSET + i - 1)
+		flags = file.read(1)[0]
+		if not flags & PRESENT:
+			raise KeyError(i)
+		
+		file.seek(_FLAGS_OFFSET + i - 1)
+		file.write(bytes([flags | CLIPPED if clipped else flags & ~CLIPPED]))
+
+
+def is_clipped(i: int) -> bool:
+	"""Checks whether a video was already clipped."""
+	_check(i)
+	data = _map()
+	return data is not None and bool(data[_FLAGS_OFFSET + i - 1] & CLIPPED)
+
+
+def episodes() -> List[int]:
+	"""Returns the indexes of all the videos in the store."""
+	data = _map()
+	if data is None:
+		return []
+	
+	flags = np.frombuffer(data, np.uint8, CAPACITY, _FLAGS_OFFSET)
+	return (np.flatnonzero(flags & PRESENT) + 1).tolist()
+
+
+def migrate(json_path: PathLike) -> None:
+	"""
+	Copies transcripts from JSON files (one per video) into the store.
+	
+	:param json_path: the directory containing the JSON files
+	"""
+	for path in sorted(Path(json_path).glob('*.json')):
+		i = int(path.stem)
+		logger.ind = i
+		logger.info(f'Migrating {path}...')
+		import_json(i, path)
+
+
+def import_json(i: int, path: PathLike) -> None:
+	"""Copies the transcript of a single video from a JSON file into the store."""
+	with open(path) as file:
+		data = json.load(file)
+	save(i, data['transcript'], data['timestamps'], data['clipped'])
+
+
+_cached: Tuple[Optional[tuple], Optional[np.memmap]] = (None, None)
+
+
+def _map() -> Optional[np.memmap]:
+	"""
+	Memory-maps the store for reading.
+	The map is reused until the file changes.
+	"""
+	global _cached
+	if not store_path.exists():
+		return None
+	
+	stat = store_path.stat()
+	key = stat.st_size, stat.st_mtime_ns
+	if _cached[0] != key:
+		data = np.memmap(store_path, np.uint8, 'r')
+		if bytes(data[:len(MAGIC)]) != MAGIC:
+			raise IOError(f'{store_path} is not a transcript store')
+		_cached = key, data
+	
+	return _cached[1]
+
+
+def _index(data: np.memmap) -> np.ndarray:
+	return np.frombuffer(data, _index_dtype, CAPACITY, _INDEX_OFFSET)
+
+
+def _check(i: int) -> None:
+	if not 0 < i <= CAPACITY:
+		raise IndexError(f'Video #{i} does not fit in the transcript store')
+
+
+@contextlib.contextmanager
+def _locked():
+	"""Opens the store for writing, creating it if needed, and locks it against other writers."""
+	if not store_path.exists():
+		with open(store_path, 'ab'):
+			pass
+	
+	with open(store_path, 'r+b') as file:
+		fcntl.flock(file, fcntl.LOCK_EX)
+		try:
+			file.seek(0, 2)
+			if file.tell() == 0:
+				file.write(MAGIC + np.array([CAPACITY, 0], '<u4').tobytes() + bytes(_HEADER_SIZE - _FLAGS_OFFSET))
+			yield file
+		finally:
+			fcntl.flock(file, fcntl.LOCK_UN)
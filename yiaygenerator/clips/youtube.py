@@ -1,52 +1,126 @@
 """Downloads YIAY videos from Youtube."""
 
-from typing import BinaryIO
+from typing import BinaryIO, NamedTuple, Optional, List
 
 from ._logging import logger
 
 import youtube_dl
 
-import tempfile
-import contextlib
+import json
 from pathlib import Path
 
-PLAYLIST_URL = 'https://www.youtube.com/playlist?list=PLiWL8lZPZ2_k1JH6urJ_H7HzH9etwmn7M',
+PLAYLIST_URL = 'https://www.youtube.com/playlist?list=PLiWL8lZPZ2_k1JH6urJ_H7HzH9etwmn7M'
+VIDEO_URL = 'https://www.youtube.com/watch?v={}'
+PAGE_SIZE = 50
 cache_path = Path('expr/cache')
+manifest_path = Path('expr/playlist.json')
 
 
-def video(i: int, only_audio: bool) -> BinaryIO:
+class Entry(NamedTuple):
+	"""A YIAY video in the playlist manifest."""
+	index: int
+	id: str
+	title: str
+	duration: Optional[float]
+	upload_date: Optional[str]
+
+
+_entries: Optional[List[Entry]] = None
+
+
+def playlist(refresh: bool = False) -> List[Entry]:
 	"""
-	Downloads a video from YouTube.
-	If the video cannot be downloaded, tries to get it from a cache directory.
+	Loads the playlist manifest, which maps indexes to video IDs.
+	
+	:param refresh: True to look for videos that were added to the playlist since the last refresh
+	:return: the videos in the playlist, oldest first (so entry i - 1 is video i)
+	"""
+	global _entries
+	if _entries is None and manifest_path.exists():
+		with open(manifest_path) as file:
+			_entries = [Entry(**e) for e in json.load(file)]
+	
+	if _entries is None or refresh:
+		_entries = _refresh(_entries or [])
+	
+	return _entries
+
+
+def _refresh(entries: List[Entry]) -> List[Entry]:
+	"""
+	Adds new videos to the manifest and saves it.
+	Only fetches the start of the playlist (where the new videos are),
+	a page at a time, until it reaches a video that's already known.
+	
+	:param entries: the current manifest
+	:return: the updated manifest
+	"""
+	known = {e.id for e in entries}
+	new = []
+	
+	logger.info('Refreshing the playlist manifest...')
+	with youtube_dl.YoutubeDL({'quiet': True, 'extract_flat': 'in_playlist'}) as yt:
+		start = 1
+		while True:
+			yt.params.update(playliststart=start, playlistend=start + PAGE_SIZE - 1)
+			page = list(yt.extract_info(PLAYLIST_URL, download=False)['entries'])
+			
+			ids = [e['id'] for e in page]
+			new.extend(i for i in ids if i not in known)
+			if len(page) < PAGE_SIZE or known.intersection(ids):
+				break
+			start += PAGE_SIZE
+	
+	# details like the upload date are only available for each video separately
+	with youtube_dl.YoutubeDL({'quiet': True}) as yt:
+		for video_id in reversed(new):  # the playlist starts with the newest video
+			info = yt.extract_info(VIDEO_URL.format(video_id), download=False)
+			entries.append(Entry(
+				len(entries) + 1, video_id,
+				info.get('title', ''), info.get('duration'), info.get('upload_date'),
+			))
+	
+	logger.info(f'Found {len(new)} new videos, {len(entries)} in total.')
+	
+	temp = manifest_path.with_suffix('.tmp')
+	with open(temp, 'w') as file:
+		json.dump([e._asdict() for e in entries], file, indent='\t')
+	temp.replace(manifest_path)
+	
+	return entries
+
+
+def video(i: int) -> BinaryIO:
+	"""
+	Gets a video from the cache directory,
+	or downloads it from YouTube into the cache directory if it's not there yet,
+	so each video is only downloaded once.
 
 	:param i: the video's index in the playlist
-	:param only_audio: True to download only audio, False to download video and audio
-	:return: a temporary file containing the file
+	:return: the video file, opened for reading
 	:raise IndexError: if i surpasses the playlist's bounds
 	:raise DownloadError: if a YouTube server side error occurs
 	"""
-	ext = '.webm' if only_audio else '.mp4'
-	
-	path = cache_path / f'{i:03d}{ext}'
+	path = cache_path / f'{i:03d}.mp4'
 	if path.exists():
 		logger.info(f'Loading {path}...')
 		return open(path, 'rb')
 	
-	f = tempfile.NamedTemporaryFile(suffix=ext)
+	entries = playlist()
+	if i > len(entries):
+		entries = playlist(refresh=True)
+	if not 0 < i <= len(entries):
+		raise IndexError(i)
 	
-	logger.info(f'Downloading {"audio" if only_audio else "video"}...')
+	# youtube_dl writes to a .part file next to the cached file and renames it when it's done,
+	# so a failed download doesn't look like a cached one
+	# (it writes to the file directly, not to stdout, which is shared by concurrent downloads)
+	logger.info('Downloading video...')
 	with youtube_dl.YoutubeDL({
 		'quiet': True,
-		'playlistreverse': True,
-		'playlist_items': str(i),
-		'format': 'bestaudio[ext=webm]' if only_audio else 'best[ext=mp4]',
-		'outtmpl': '-',
+		'format': 'best[ext=mp4]',
+		'outtmpl': str(path),
 	}) as yt:
-		with contextlib.redirect_stdout(f):
-			yt.download(PLAYLIST_URL)
-	
-	if f.tell() == 0:
-		raise IndexError(i)
+		yt.download([VIDEO_URL.format(entries[i - 1].id)])
 	
-	f.seek(0)
-	return f
+	return open(path, 'rb')
@@ -1,33 +1,100 @@
 """Django Channels consumer(s) for Websocket communication."""
 
-from channels.generic.websocket import WebsocketConsumer
+from typing import Optional, Dict
 
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+
+from . import scheduling
+
+import asyncio
 import urllib.parse
-import time
 
+DEFAULT_DURATION = 60.0
 
-class YiayConsumer(WebsocketConsumer):
+
+class YiayConsumer(AsyncWebsocketConsumer):
 	"""
 	Websocket consumer that manages the YIAY generation.
 	Sends progress updates in real-time,
 	and sends the video file when the generation is done.
+	
+	Videos are generated by render workers over the channel layer (see the workers module),
+	or by the web process's scheduler if there is no render channel.
+	Either way the consumer gets render.* messages, so it never blocks the event loop.
 	"""
 	
-	def connect(self):
+	async def connect(self):
 		"""
 		Connects to a client and initiates YIAY generation.
 		
 		**Protocol Specification:**
-		Progress: P<byte>
-		Data:     D<bytes>
+		Queue:    Q<byte>  (position in the queue, while waiting for a worker)
+		Progress: P<byte>  (percent)
+		Data:     D<bytes> (a chunk of the video, sent in order after the progress reaches 100)
+		Fragment: F<bytes> (a chunk of the video as fragmented mp4, sent in order while it's generated,
+		                    instead of the data frames if the query has stream=1)
+		With preview=1 in the query, a quick low resolution preview is generated,
+		and a later request for the same question without it uses the same tweets and clips.
+		The server closes the connection after the last chunk,
+		or with code 4503 if there are too many requests.
 		"""
-		self.accept()
+		await self.accept()
 		query = urllib.parse.parse_qs(self.scope['query_string'].decode())
-		dummy_func(f'question = {query["question"][0]}, hashtag = {query["hashtag"][0]}', self)
+		try:
+			question = query['question'][0]
+			hashtag = query['hashtag'][0]
+			duration = float(query.get('duration', [DEFAULT_DURATION])[0])
+			stream = query.get('stream', ['0'])[0] == '1'
+			preview = query.get('preview', ['0'])[0] == '1'
+		except (KeyError, ValueError):
+			await self.close(code=4000)
+			return
+		
+		self._percent = -1
+		if settings.RENDER_CHANNEL:
+			await self.channel_layer.send(settings.RENDER_CHANNEL, {
+				'type': 'render.request',
+				'reply_channel': self.channel_name,
+				'question': question, 'hashtag': hashtag, 'duration': duration, 'preview': preview,
+				'stream': stream,
+			})
+		else:
+			self._task = asyncio.ensure_future(
+				scheduling.serve((question, hashtag, duration, preview), self.dispatch, stream)
+			)
 	
-
-def dummy_func(text: str, consumer: WebsocketConsumer):
-	for i in range(100):
-		consumer.send(text)
-		time.sleep(3)
-
+	async def disconnect(self, code):
+		task: Optional[asyncio.Future] = getattr(self, '_task', None)
+		if task is not None:
+			task.cancel()
+		elif settings.RENDER_CHANNEL:
+			await self.channel_layer.send(settings.RENDER_CHANNEL, {
+				'type': 'render.cancel',
+				'reply_channel': self.channel_name,
+			})
+	
+	async def render_queued(self, message: Dict) -> None:
+		await self.send(bytes_data=b'Q' + bytes([min(255, message['position'])]))
+	
+	async def render_progress(self, message: Dict) -> None:
+		"""Sends a progress frame, unless the percentage didn't change."""
+		percent = min(100, int(message['done'] * 100))
+		if percent > self._percent:
+			self._percent = percent
+			await self.send(bytes_data=b'P' + bytes([percent]))
+	
+	async def render_data(self, message: Dict) -> None:
+		await self.send(bytes_data=b'D' + message['data'])
+	
+	async def render_fragment(self, message: Dict) -> None:
+		await self.send(bytes_data=b'F' + message['data'])
+	
+	async def render_done(self, message: Dict) -> None:
+		await self.close()
+	
+	async def render_failed(self, message: Dict) -> None:
+		await self.close(code=4500)
+	
+	async def render_rejected(self, message: Dict) -> None:
+		await self.close(code=4503)
@@ -1,3 +1,4 @@
 """Main generator functionality."""
 
-from .rendering import yiay
+from .rendering import yiay, render
+from .planning import plan, Plan
@@ -0,0 +1,157 @@
+"""
+Plans the final video before anything is rendered.
+
+Clip durations are known from the clip catalogue, so the tweets and the concrete clips
+are chosen up front to fill the target duration, and only the planned clips are opened
+and only the planned tweets are rendered to images.
+Plans can be stored as JSON (see dumps and loads), so a video can be rendered again from the same plan.
+"""
+
+from typing import NamedTuple, Tuple, Optional, Dict, List, Iterable
+
+from . import twitter
+from .. import clips, homophones
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+TOLERANCE = 0.5
+"""How far below the target duration (in seconds) a plan is considered full."""
+MAX_CANDIDATES = 100
+"""Maximum number of tweets to consider for a single video."""
+
+
+class Part(NamedTuple):
+	"""A part of the final video: clips of Jack reading something, with an optional overlay."""
+	clips: Tuple[int, ...]
+	"""Indexes of the clips in the catalogue, in order."""
+	duration: float
+	text: Optional[str] = None
+	"""Text to display over the clips (the question)."""
+	tweet: Optional[Dict] = None
+	"""A tweet to display over the clips (an answer)."""
+
+
+class Plan(NamedTuple):
+	"""The parts of a video, in order."""
+	parts: Tuple[Part, ...]
+	version: int
+	"""The version of the clip catalogue the clip indexes refer to."""
+	
+	@property
+	def duration(self) -> float:
+		return sum(part.duration for part in self.parts)
+	
+	@property
+	def tweets(self) -> Tuple[str, ...]:
+		"""IDs of the tweets used as answers."""
+		return tuple(part.tweet['id_str'] for part in self.parts if part.tweet is not None)
+
+
+def plan(question: str, hashtag: str, duration: float, catalogue: clips.ClipList) -> Plan:
+	"""
+	Plans a YIAY video.
+	
+	:param question: the YIAY question
+	:param hashtag: the twitter hashtag the question should be answered with
+	:param duration: the maximum duration of the video
+	:param catalogue: the clips to use
+	:return: the video's plan
+	"""
+	planner = _Planner(catalogue)
+	
+	head = [
+		planner.segment('%INTRO'),
+		planner.words(question.split(), text=question),
+		planner.segment('%START'),
+	]
+	tail = [
+		planner.words(['and']),
+		planner.words(['finally']),
+		None,  # the first answer
+		planner.clip(_latest(catalogue, '%OUTRO')),  # only use the latest outro
+		planner.segment('%END'),
+	]
+	
+	answers = twitter.tweets(hashtag, catalogue)
+	first = next(answers, None)
+	if first is None:
+		raise LookupError(f'No readable tweets with {hashtag}')
+	tail[2] = planner.answer(*first)
+	
+	fitted = _fit(planner, answers, duration - sum(part.duration for part in head + tail))
+	
+	# the other answers come before "and finally", latest first
+	return Plan((*head, *reversed(fitted), *tail), catalogue.version)
+
+
+def dumps(plan: Plan) -> bytes:
+	"""Serializes a plan to JSON."""
+	return json.dumps({'version': plan.version, 'parts': plan.parts}).encode()
+
+
+def loads(data: bytes) -> Plan:
+	"""Deserializes a plan from JSON."""
+	obj = json.loads(data)
+	return Plan(
+		tuple(Part(tuple(clips), duration, text, tweet) for clips, duration, text, tweet in obj['parts']),
+		obj['version'],
+	)
+
+
+def _fit(planner: '_Planner', answers: Iterable[Tuple[List[str], Dict]], remaining: float) -> List[Part]:
+	"""
+	Greedily picks answers that fit in the remaining duration,
+	skipping the ones that are too long.
+	
+	:param planner: the planner to draw clips with
+	:param answers: readable words and a tweet for each candidate answer
+	:param remaining: the duration left to fill
+	:return: the picked answers
+	"""
+	fitted = []
+	for n, (words, tweet) in enumerate(answers):
+		if remaining < TOLERANCE or n >= MAX_CANDIDATES:
+			break
+		
+		answer = planner.answer(words, tweet)
+		if answer.duration <= remaining:
+			fitted.append(answer)
+			remaining -= answer.duration
+	
+	logger.info(f'Planned {len(fitted) + 1} answers, {remaining:.2f} seconds short of the target.')
+	return fitted
+
+
+class _Planner:
+	"""Draws clips for the parts of a single video."""
+	def __init__(self, catalogue: clips.ClipList) -> None:
+		self.catalogue = catalogue
+		self.sampler = catalogue.sampler()
+	
+	def words(self, words: List[str], text: Optional[str] = None, tweet: Optional[Dict] = None) -> Part:
+		"""Plans a part of Jack reading some words."""
+		indexes = tuple(self.sampler.draw(homophones.get(word)) for word in words)
+		return Part(indexes, sum(self.catalogue.durations[i] for i in indexes), text, tweet)
+	
+	def segment(self, name: str) -> Part:
+		"""
+		Plans a part of a segment of a YIAY video, like %INTRO
+		(segment names aren't words, so they're not replaced by homophones).
+		"""
+		return self.clip(self.sampler.draw(name))
+	
+	def clip(self, i: int) -> Part:
+		"""Plans a part of a single clip."""
+		return Part((i,), self.catalogue.durations[i])
+	
+	def answer(self, words: List[str], tweet: Dict) -> Part:
+		"""Plans a part of Jack reading a tweet."""
+		return self.words(words, tweet=tweet)
+
+
+def _latest(catalogue: clips.ClipList, word: str) -> int:
+	"""Finds the clip of a word from the latest episode."""
+	return max(catalogue.clips(word), key=lambda i: catalogue.episodes[i])
@@ -1,128 +1,339 @@
-"""Generates the final video from answers and existing clips."""
+"""
+Generates the final video from answers and existing clips.
 
-from . import twitter
-from .. import clips, homophones
+The video is split into independent segments (the intro, the question, each answer, etc.),
+which are encoded in parallel by worker processes and then joined at the container level.
+Segments that are used as-is are not encoded at all, as long as the clips are normalized
+(see clips.normalizing).
+"""
 
-import moviepy.video as mpy
-import moviepy.video.VideoClip
-from moviepy.video.io.VideoFileClip import VideoFileClip
-from moviepy.video.compositing.CompositeVideoClip import CompositeVideoClip
-from moviepy.video.compositing.concatenate import concatenate_videoclips
+from typing import Optional, List, Tuple, Dict, Callable, BinaryIO
+
+from . import twitter, planning
+from .segments import Segment, Encoding
+from . import segments
+from .. import clips, ffmpeg
+from ..diskcache import DiskCache
 
 from tempfile import NamedTemporaryFile
 from contextlib import ExitStack
-import copy
-import random
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import shutil
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+PROFILE = clips.normalizing.PROFILE
+PREVIEW = clips.normalizing.PREVIEW
+RENDER_JOBS = int(os.environ.get('RENDER_JOBS', os.cpu_count()))
+"""The number of worker processes that encode segments."""
+videos = DiskCache(
+	os.environ.get('VIDEO_CACHE_PATH', 'expr/videos/'),
+	int(os.environ.get('VIDEO_CACHE_BUDGET', 2 * 1024 ** 3)),
+	'.mp4',
+)
+"""Generated videos, by their question, hashtag, duration, tweets, clip list version and quality."""
+plans = DiskCache(
+	os.environ.get('PLAN_CACHE_PATH', 'expr/plans/'),
+	int(os.environ.get('PLAN_CACHE_BUDGET', 64 * 1024 ** 2)),
+	'.json',
+)
+"""Plans of previews, by their question, hashtag and duration, to render them at full quality later."""
+
+Progress = Callable[[float], None]
+"""A callback that receives the fraction of the work that is done."""
+Stream = Callable[[bytes], None]
+"""A callback that receives the video as fragmented mp4 data, in order."""
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+	"""Creates the worker processes when they're first needed, and keeps them for the next requests."""
+	global _pool
+	with _pool_lock:  # renders are requested from several threads at once
+		if _pool is None:
+			_pool = ProcessPoolExecutor(RENDER_JOBS)
+		return _pool
 
 
-def yiay(question: str, hashtag: str, duration: float) -> NamedTemporaryFile:
+PLANNED = 0.05
+RENDERED = 0.15
+ENCODED = 0.95
+"""Progress after each stage of the generation."""
+
+
+def yiay(
+		question: str, hashtag: str, duration: float,
+		progress: Optional[Progress] = None, stream: Optional[Stream] = None, preview: bool = False
+) -> BinaryIO:
 	"""
-	Generates a YIAY video.
+	Generates a YIAY video, or gets it from the cache
+	if the same video (with the same tweets and clips) was already generated.
+	
+	A preview is rendered quickly from low resolution proxies of the clips,
+	and the full quality video of the same question later uses the same plan (tweets and clips).
 	
 	:param question: the YIAY question
 	:param hashtag: the twitter hashtag the question should be answered with
 	:param duration: the maximum duration of the video
-	:return: a temporary file containing the generated video
+	:param progress: a callback to report the progress to
+	:param stream: a callback to stream the video to while it's generated
+	:param preview: whether to render a preview
+	:return: a file containing the generated video (temporary, unless it's in the cache)
 	"""
+	progress = progress or _ignore
 	clip_list = clips.get_list()
 	
-	with _ClipStack(clip_list) as s:
-		s.add_word('%INTRO')
-		_build_question_clip(question, s)
-		s.add_word('%START')
-		
-		s.add_word(homophones.get('and'))
-		s.add_word(homophones.get('finally'))
-		
-		s.add_clip(VideoFileClip(str(sorted(clip_list['%OUTRO'])[-1])))  # only use the latest outro
-		s.add_word('%END')
-		
-		tweets = twitter.tweets(hashtag, clip_list)
-		_build_answer_clip(*next(tweets), s, 5)
-		
-		for tweet in tweets:
-			_build_answer_clip(*tweet, s, 3)
-			if s.duration >= duration:
-				break
+	plan_key = plans.key(question, hashtag, duration)
+	plan = None if preview else _previewed(plan_key, clip_list)
+	if plan is None:
+		plan = planning.plan(question, hashtag, duration, clip_list)
+		if preview:
+			plans.write(plan_key, planning.dumps(plan))
+	progress(PLANNED)
+	
+	key = videos.key(question, hashtag, duration, plan.tweets, plan.version, preview)
+	cached = videos.get(key)
+	try:
+		video = open(cached, 'rb') if cached is not None else None
+	except FileNotFoundError:  # evicted by another process since, so it's a miss after all
+		video = None
+	if video is not None:
+		logger.info(f'Using cached video {cached.name}')
+		progress(1.0)
+		if stream is not None:
+			with NamedTemporaryFile(suffix='.mp4') as fragment:
+				ffmpeg.fragment([cached], fragment.name)
+				stream(fragment.read())
+		return video
+	
+	video = render(plan, clip_list, progress, stream, preview)
+	videos.put(key, video.name)
+	return video
+
+
+def _previewed(key: str, clip_list: clips.ClipList) -> Optional[planning.Plan]:
+	"""Loads the plan of a preview, if it was made with the current clip list."""
+	path = plans.get(key)
+	if path is None:
+		return None
+	
+	plan = planning.loads(path.read_bytes())
+	if plan.version != clip_list.version:
+		return None
+	
+	logger.info('Using the plan of the preview')
+	return plan
+
+
+def render(
+		plan: planning.Plan, clip_list: clips.ClipList,
+		progress: Optional[Progress] = None, stream: Optional[Stream] = None, preview: bool = False
+) -> NamedTemporaryFile:
+	"""
+	Renders a planned YIAY video.
+	
+	:param plan: the video's plan
+	:param clip_list: the clips the plan was made with
+	:param progress: a callback to report the progress to
+	:param stream: a callback to stream the video to, segment by segment, as soon as each one is ready
+	:param preview: whether to render a quick low resolution preview
+	:return: a temporary file containing the generated video
+	"""
+	if plan.version != clip_list.version:
+		raise ValueError('The plan was made with a different version of the clip list')
+	
+	progress = progress or _ignore
+	tweets = [part.tweet for part in plan.parts if part.tweet is not None]
+	images = iter(twitter.images(tweets))  # all at once, so they're rendered in batches
+	with _ClipStack(clip_list, preview) as s:
+		for part in plan.parts:
+			s.add_part(part, next(images) if part.tweet is not None else None)
+		progress(RENDERED)
 		
 		final = NamedTemporaryFile(suffix='.mp4')
-		concatenate_videoclips(s.clips).write_videofile(final.name, logger=None)
+		s.write(final.name, lambda done: progress(RENDERED + done * (ENCODED - RENDERED)), stream)
+		progress(1.0)
 	
 	return final
 
 
+def _ignore(done: float) -> None:
+	pass
+
+
 class _ClipStack(ExitStack):
-	"""Helper class that manages clip and image files."""
-	def __init__(self, clip_list: clips.ClipList) -> None:
+	"""Helper class that manages the video's segments and their files."""
+	def __init__(self, clip_list: clips.ClipList, preview: bool = False) -> None:
 		super().__init__()
 		
-		self.clips = []
+		self.segments: List[Segment] = []
 		self.duration = 0.0
 		
-		self._original = clip_list
-		self._clips = copy.deepcopy(clip_list)
-	
-	def add_clip(self, clip: mpy.VideoClip.VideoClip) -> None:
-		"""Adds a clip object to the stack."""
-		self.duration += clip.duration
-		self.clips.append(self.enter_context(clip))
-	
-	def make_word(self, word: str) -> VideoFileClip:
-		"""Gets a clip object of Jack saying a word."""
-		if not self._clips[word]:
-			self._clips[word] = self._original[word].copy()
+		self._clips = clip_list
+		self._preview = preview
+		self._profile = PREVIEW if preview else PROFILE
+		self._indexes: Dict[Path, int] = {}
+	
+	def add_segment(self, segment: Segment, index: Optional[int] = None) -> None:
+		"""Adds a segment to the stack, at the end or at a given index."""
+		self.duration += segment.duration
+		self.segments.insert(len(self.segments) if index is None else index, segment)
+	
+	def add_part(self, part: planning.Part, image: Optional[Path] = None) -> None:
+		"""
+		Adds a planned part to the stack.
+		
+		:param part: the part to add
+		:param image: the image of the part's tweet (see twitter.images), which is rendered if it's not given
+		"""
+		if part.tweet is not None:
+			image = self._pin(part.tweet, image or twitter.image(part.tweet))
+		
+		paths = tuple(self._path(i) for i in part.clips)
+		self.add_segment(Segment(paths, part.duration, text=part.text, image=image))
+	
+	def _pin(self, tweet: Dict, image: Path) -> str:
+		"""
+		Copies a tweet image out of the cache for the rest of the render,
+		since other renders might evict it before the workers get to it.
+		If it was already evicted, the tweet is rendered again.
+		
+		:param tweet: the tweet
+		:param image: the tweet's image in the cache
+		:return: the path of the copy
+		"""
+		pinned = self.enter_context(NamedTemporaryFile(suffix=image.suffix)).name
+		try:
+			shutil.copyfile(str(image), pinned)
+		except FileNotFoundError:
+			logger.info('A tweet image was evicted from the cache, rendering it again')
+			shutil.copyfile(str(twitter.image(tweet)), pinned)
+		return pinned
+	
+	def _path(self, i: int) -> Path:
+		"""Gets the path of a clip from the catalogue, and remembers where it came from."""
+		path = self._clips.path(i, self._preview)
+		self._indexes[path] = i
+		return path
+	
+	def write(self, filename: str, progress: Progress = _ignore, stream: Optional[Stream] = None) -> None:
+		"""
+		Writes the segments in the stack to a video file.
+		Segments are encoded in parallel to a shared encoding, and then joined.
+		Plain segments are copied as-is when their clips already have that encoding.
+		
+		:param filename: the path to write the video to
+		:param progress: a callback to report the encoded fraction of the segments to
+		:param stream: a callback to stream the segments to, in order, as soon as each one is ready
+		"""
+		encoding, copy_plain = self._encoding()
+		
+		pool = _get_pool()
+		parts: List[List[str]] = []  # the files of each segment
+		ready: List[bool] = []
+		futures = {}
+		for n, segment in enumerate(self.segments):
+			if segment.plain and copy_plain:
+				parts.append([str(path) for path in segment.paths])
+				ready.append(True)
+				continue
+			
+			part = self.enter_context(NamedTemporaryFile(suffix='.mp4')).name
+			futures[pool.submit(segments.encode, segment, encoding, part)] = n
+			parts.append([part])
+			ready.append(False)
+		
+		streamer = _Streamer(stream, parts) if stream is not None else None
+		if streamer is not None:
+			streamer.advance(ready)
+		
+		logger.info(f'Encoding {len(futures)} of {len(self.segments)} segments...')
+		total = sum(self.segments[n].duration for n in futures.values()) or 1.0
+		done = 0.0
+		worker = ffmpeg_memory = total_memory = 0
+		for future in as_completed(futures):
+			memory = future.result()
+			worker = max(worker, memory.worker)
+			ffmpeg_memory = max(ffmpeg_memory, memory.ffmpeg)
+			total_memory = max(total_memory, memory.worker + memory.ffmpeg)
+			n = futures[future]
+			ready[n] = True
+			done += self.segments[n].duration
+			progress(done / total)
+			
+			if streamer is not None:
+				streamer.advance(ready)
+		
+		if futures:
+			logger.info(
+				f'Peak memory of a segment: {total_memory / 1024 ** 2:.1f} MiB '
+				f'({worker / 1024 ** 2:.1f} MiB in the worker, {ffmpeg_memory / 1024 ** 2:.1f} MiB in ffmpeg)'
+			)
+		ffmpeg.concat([path for paths in parts for path in paths], filename)
+	
+	def _encoding(self) -> Tuple[Encoding, bool]:
+		"""
+		Finds the encoding the segments should be encoded to.
+		
+		:return: the encoding, and whether plain segments already have it
+		"""
+		paths = {path for segment in self.segments if segment.plain for path in segment.paths}
 		
-		path = random.sample(self._clips[word], 1)[0]
-		self._clips[word].remove(path)
+		profile = self._profile
+		# clips that merely share a frame size and rate can still differ in codec profile, parameter sets,
+		# pixel format or audio, so only normalized clips are known to match the encoded segments
+		if all(self._is_normalized(path) for path in paths):
+			return _profile_encoding(profile), True
 		
-		return self.enter_context(VideoFileClip(str(path)))
+		logger.info('Some clips are not normalized, encoding all of them.')
+		return _profile_encoding(profile), False
 	
-	def add_word(self, word: str) -> None:
-		"""Adds a clip of Jack saying a word to the stack."""
-		clip = self.make_word(word)
-		self.duration += clip.duration
-		self.clips.append(clip)  # already in context
+	def _is_normalized(self, path: Path) -> bool:
+		"""Checks whether a clip file is normalized to the profile of the video (house or preview)."""
+		i = self._indexes.get(path)
+		if i is None:
+			return False
+		return self._clips.proxies[i] is not None if self._preview else bool(self._clips.normalized[i])
 
 
-def _build_question_clip(question: str, s: _ClipStack) -> None:
+class _Streamer:
 	"""
-	Builds a clip of Jack reading the YIAY question.
-	
-	:param question: the question to read
-	:param s: the stack to push the clips into
+	Streams segments as fragmented mp4 data, in order, as soon as the segments before them were streamed.
+	Each segment is a self-contained fragmented mp4 that starts where the previous one ended.
 	"""
-	reading_clip = s.enter_context(concatenate_videoclips([
-		s.make_word(homophones.get(word)) for word in question.split()
-	]))
+	def __init__(self, stream: Stream, parts: List[List[str]]) -> None:
+		"""
+		:param stream: the callback to stream the data to
+		:param parts: the files of each segment
+		"""
+		self.stream = stream
+		self.parts = parts
+		self.next = 0
+		self.offset = 0.0
 	
-	s.add_clip(CompositeVideoClip([
-		reading_clip,
-		mpy.VideoClip.TextClip(  # TODO: it doesn't look exactly like jack's font
-			question,
-			color='white', font='Cooper-Black', fontsize=64,
-			stroke_color='black', stroke_width=3,
-		).set_duration(reading_clip.duration).set_position(('center', 'bottom'))
-	]))
+	def advance(self, ready: List[bool]) -> None:
+		"""Streams the ready segments that are next in order."""
+		while self.next < len(self.parts) and ready[self.next]:
+			paths = self.parts[self.next]
+			with NamedTemporaryFile(suffix='.mp4') as fragment:
+				ffmpeg.fragment(paths, fragment.name, self.offset)
+				self.stream(fragment.read())
+			
+			# the actual durations, since a gap in the timestamps would stall the playback
+			self.offset += sum(ffmpeg.info(path).duration for path in paths)
+			self.next += 1
 
 
-def _build_answer_clip(answer: str, image: NamedTemporaryFile, s: _ClipStack, index: int) -> None:
-	"""
-	Builds a clip of Jack reading a YIAY answer,
-	and adds it to the stack.
-	
-	:param answer: the answer as text to read
-	:param image: image of a tweet to display
-	:param s: the stack to push the clips into
-	:param index: the index to insert the clip at in the stack
-	"""
-	reading_clip = s.enter_context(concatenate_videoclips([
-		s.make_word(homophones.get(word)) for word in answer
-	]))
-	clip = s.enter_context(CompositeVideoClip([
-		reading_clip,
-		mpy.VideoClip.ImageClip(s.enter_context(image).name, duration=reading_clip.duration)
-			.set_position(('center', 'bottom')),
-	]))
-	
-	s.duration += clip.duration
-	s.clips.insert(index, clip)
+def _profile_encoding(profile: clips.normalizing.Profile) -> Encoding:
+	"""The encoding of clips normalized to a profile (including the preset, so they can be joined)."""
+	return Encoding(
+		profile.size, profile.fps, profile.codec,
+		profile.audio_codec, profile.audio_fps, profile.audio_channels,
+		tuple(profile.video_args()),
+	)
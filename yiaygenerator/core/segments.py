@@ -0,0 +1,333 @@
+"""
+Describes the independent parts of the final video,
+and encodes them (in worker processes, so they only hold plain data).
+
+A segment is encoded by streaming its frames from ffmpeg decoders (one per clip, one after another)
+to an ffmpeg encoder, through a single frame buffer where the overlays are blended in.
+Each clip is scaled and resampled on its own, so clips with different encodings can be mixed,
+and its audio is cut or padded to the length of its frames, so the sound stays in sync when it's muxed in.
+The overlays are rasterized once, so memory use doesn't depend on the length of the segment,
+and text rasters are cached on disk by their text and style, so the same question isn't rasterized again.
+"""
+
+from typing import NamedTuple, Tuple, Optional, List, BinaryIO
+
+import numpy as np
+import moviepy.video as mpy
+import moviepy.video.VideoClip
+import moviepy.video.fx.resize
+
+from .. import ffmpeg
+from ..diskcache import DiskCache
+
+import io
+import os
+import subprocess
+import resource
+import tempfile
+from pathlib import Path
+
+OVERLAY_HEIGHT = 720
+"""The frame height the overlays are designed for (they're scaled for other sizes, like previews)."""
+DEFAULT_FPS = 30
+"""The frame rate of segments whose clips have an unknown frame rate."""
+AUDIO_CHUNK_SIZE = 1024 ** 2
+"""How much audio is copied at a time when appending a clip's audio to the segment's."""
+
+texts = DiskCache(
+	os.environ.get('TEXT_CACHE_PATH', 'expr/assets/texts/'),
+	int(os.environ.get('TEXT_CACHE_BUDGET', 128 * 1024 ** 2)),
+	'.npy',
+)
+"""RGBA rasters of text overlays, by their text and style."""
+
+
+class Segment(NamedTuple):
+	"""A part of the final video: clips of Jack reading something, with an optional overlay."""
+	paths: Tuple[Path, ...]
+	"""The clips to read, in order."""
+	duration: float
+	text: Optional[str] = None
+	"""Text to display over the clips (the question)."""
+	image: Optional[str] = None
+	"""Path to an image to display over the clips (a tweet)."""
+	
+	@property
+	def plain(self) -> bool:
+		"""Whether the clips are used as-is."""
+		return self.text is None and self.image is None
+
+
+class Encoding(NamedTuple):
+	"""Encoding parameters the segments have to share to be joined."""
+	size: Tuple[int, int]
+	fps: Optional[float]
+	codec: str
+	audio_codec: str
+	audio_fps: int
+	audio_channels: int
+	params: Tuple[str, ...] = ()
+	"""Extra ffmpeg output arguments."""
+
+
+class Memory(NamedTuple):
+	"""The peak resident memory of encoding a segment, in bytes."""
+	worker: int
+	"""The worker process (the frame buffer and the overlays)."""
+	ffmpeg: int
+	"""The ffmpeg processes that run at the same time (the encoder and a decoder, or the muxer)."""
+
+
+def encode(segment: Segment, encoding: Encoding, filename: str) -> Memory:
+	"""
+	Encodes a segment to a video file.
+	
+	:param segment: the segment to encode
+	:param encoding: the encoding parameters to use
+	:param filename: the path to write the segment to
+	:return: the peak memory use of the worker and of its ffmpeg processes while encoding
+	:raise IOError: if ffmpeg fails
+	"""
+	_reset_peak_memory()
+	
+	width, height = encoding.size
+	with tempfile.TemporaryDirectory() as tmp:
+		video = os.path.join(tmp, 'video.mp4')
+		audio = os.path.join(tmp, 'audio.pcm')
+		
+		encoder = ffmpeg.popen(
+			'-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}',
+			'-r', str(encoding.fps or DEFAULT_FPS), '-i', '-',
+			'-c:v', encoding.codec, '-pix_fmt', 'yuv420p', *encoding.params, video,
+			stdin=subprocess.PIPE,
+		)
+		compositor = _Compositor(encoding, _overlays(segment, encoding.size), encoder.stdin)
+		try:
+			with open(audio, 'wb') as samples:
+				for path in segment.paths:
+					compositor.add(path, samples, os.path.join(tmp, 'clip.pcm'))
+		except BrokenPipeError:  # the encoder failed
+			pass
+		finally:
+			encoder.stdin.close()
+			code, encoder_memory = _wait(encoder)
+		
+		if code:
+			raise IOError(f'Encoding {filename} failed (ffmpeg exited with {code})')
+		
+		channels = '-ar', str(encoding.audio_fps), '-ac', str(encoding.audio_channels)
+		muxer = ffmpeg.popen(
+			'-i', video, '-f', 's16le', *channels, '-i', audio,
+			'-map', '0:v', '-map', '1:a', '-c:v', 'copy', '-c:a', encoding.audio_codec, *channels,
+			filename,
+		)
+		code, muxer_memory = _wait(muxer)
+		if code:
+			raise IOError(f'Muxing {filename} failed (ffmpeg exited with {code})')
+	
+	return Memory(_peak_memory(), max(encoder_memory + compositor.memory, muxer_memory))
+
+
+class _Compositor:
+	"""Decodes clips one after another, and writes their frames to an encoder with the overlays blended in."""
+	def __init__(self, encoding: Encoding, overlays: List['_Overlay'], output: BinaryIO) -> None:
+		"""
+		:param encoding: the encoding of the segment
+		:param overlays: the overlays to blend into every frame
+		:param output: the encoder's raw video input
+		"""
+		self.encoding = encoding
+		self.fps = encoding.fps or DEFAULT_FPS
+		self.overlays = overlays
+		self.output = output
+		self.frames = 0
+		self.memory = 0  # the peak resident memory of the decoders, in bytes
+		
+		width, height = encoding.size
+		self.frame = np.empty((height, width, 3), np.uint8)
+		self.buffer = memoryview(self.frame).cast('B')
+	
+	def add(self, path: Path, samples: BinaryIO, audio: str) -> None:
+		"""
+		Writes the frames of a clip to the encoder, and appends its audio to the segment's
+		(silence if it has none).
+		
+		:param path: the clip to add
+		:param samples: the segment's raw audio (16-bit samples)
+		:param audio: a temporary path for the clip's raw audio
+		:raise IOError: if ffmpeg fails to decode the clip
+		"""
+		width, height = self.encoding.size
+		has_audio = ffmpeg.info(path).audio
+		decoder = ffmpeg.popen(
+			'-i', str(path),
+			'-map', '0:v:0', '-vf', (
+				f'scale={width}:{height}:force_original_aspect_ratio=decrease,'
+				f'pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={self.fps}'
+			),
+			'-f', 'rawvideo', '-pix_fmt', 'rgb24', '-',
+			# an output without streams is an error, so the audio is only mapped if there is some
+			*((
+				'-map', '0:a:0', '-ar', str(self.encoding.audio_fps), '-ac', str(self.encoding.audio_channels),
+				'-f', 's16le', audio,
+			) if has_audio else ()),
+			stdout=subprocess.PIPE,
+		)
+		try:
+			while _read_frame(decoder.stdout, self.buffer):
+				for overlay in self.overlays:
+					overlay.blend(self.frame)
+				self.output.write(self.buffer)
+				self.frames += 1
+		finally:
+			decoder.stdout.close()
+			code, memory = _wait(decoder)
+			self.memory = max(self.memory, memory)
+		
+		if code:
+			raise IOError(f'Decoding {path} failed (ffmpeg exited with {code})')
+		
+		# the audio up to the end of the clip's last frame, counted from the start of the segment,
+		# so rounding errors don't add up
+		sample_size = 2 * self.encoding.audio_channels
+		size = round(self.frames / self.fps * self.encoding.audio_fps) * sample_size - samples.tell()
+		with open(audio, 'rb') if has_audio else io.BytesIO() as file:
+			while size > 0:
+				chunk = file.read(min(size, AUDIO_CHUNK_SIZE))
+				if not chunk:
+					break
+				samples.write(chunk)
+				size -= len(chunk)
+		if size > 0:  # the audio is shorter than the video
+			samples.write(bytes(size))
+
+
+class _Overlay:
+	"""An image that was rasterized once, and is blended into frames in place."""
+	def __init__(self, rgb: np.ndarray, alpha: Optional[np.ndarray], size: Tuple[int, int]) -> None:
+		"""
+		:param rgb: the image
+		:param alpha: the image's opacity (0 to 1), or None if it's opaque
+		:param size: the size of the frames, to place the image at the bottom center of
+		"""
+		width, height = size
+		h, w = rgb.shape[:2]
+		x, y = (width - w) // 2, height - h
+		
+		# crop the parts that are outside of the frame
+		crop = slice(max(0, -y), min(h, height - y)), slice(max(0, -x), min(w, width - x))
+		self.region = slice(max(0, y), y + h), slice(max(0, x), x + w)
+		
+		if alpha is None:
+			self.rgb = np.ascontiguousarray(rgb[crop], np.uint8)
+			self.opacity = None
+		else:
+			opacity = alpha[crop][..., np.newaxis].astype(np.float32)
+			self.rgb = rgb[crop] * opacity  # premultiplied
+			self.opacity = 1 - opacity
+			self._blended = np.empty_like(self.rgb)
+	
+	def blend(self, frame: np.ndarray) -> None:
+		"""Draws the image over a frame."""
+		region = frame[self.region]
+		if self.opacity is None:
+			region[...] = self.rgb
+			return
+		
+		np.multiply(region, self.opacity, out=self._blended)
+		self._blended += self.rgb
+		np.copyto(region, self._blended, casting='unsafe')
+
+
+def _overlays(segment: Segment, size: Tuple[int, int]) -> List[_Overlay]:
+	"""Rasterizes the overlays of a segment, for frames of a given size."""
+	scale = size[1] / OVERLAY_HEIGHT
+	overlays = []
+	
+	if segment.text is not None:
+		rgba = _text(
+			segment.text,  # TODO: it doesn't look exactly like jack's font
+			color='white', font='Cooper-Black', fontsize=round(64 * scale),
+			stroke_color='black', stroke_width=3 * scale,
+		)
+		overlays.append(_Overlay(rgba[..., :3], rgba[..., 3] / 255, size))
+	
+	if segment.image is not None:
+		clip = mpy.VideoClip.ImageClip(segment.image)
+		if scale != 1:
+			clip = clip.fx(mpy.fx.resize.resize, scale)
+		mask = clip.mask.get_frame(0) if clip.mask is not None else None  # tweets are JPEGs, but just in case
+		overlays.append(_Overlay(clip.get_frame(0), mask, size))
+		clip.close()
+	
+	return overlays
+
+
+def _text(text: str, **style) -> np.ndarray:
+	"""
+	Rasterizes text with ImageMagick, or gets the raster from the cache.
+	
+	:param text: the text to rasterize
+	:param style: TextClip arguments
+	:return: an RGBA image
+	"""
+	key = texts.key(text, style)
+	path = texts.get(key)
+	if path is not None:
+		try:
+			return np.load(str(path))
+		except FileNotFoundError:  # evicted by another process since, so it's a miss after all
+			pass
+	
+	clip = mpy.VideoClip.TextClip(text, **style)
+	rgba = np.dstack([clip.get_frame(0), np.rint(clip.mask.get_frame(0) * 255)]).astype(np.uint8)
+	clip.close()
+	
+	data = io.BytesIO()
+	np.save(data, rgba)
+	texts.write(key, data.getvalue())
+	return rgba
+
+
+def _read_frame(stream: BinaryIO, buffer: memoryview) -> bool:
+	"""Reads a whole frame into a buffer, or returns False at the end of the stream."""
+	read = 0
+	while read < len(buffer):
+		n = stream.readinto(buffer[read:])
+		if not n:
+			return False
+		read += n
+	return True
+
+
+def _reset_peak_memory() -> None:
+	"""Resets the peak resident memory of the process (only on Linux), to measure it for a single segment."""
+	try:
+		with open('/proc/self/clear_refs', 'w') as file:
+			file.write('5')
+	except OSError:
+		pass
+
+
+def _wait(process: subprocess.Popen) -> Tuple[int, int]:
+	"""
+	Waits for an ffmpeg process to exit.
+	
+	:param process: the process
+	:return: its exit code, and its peak resident memory in bytes
+	"""
+	_, status, usage = os.wait4(process.pid, 0)
+	process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+	return process.returncode, usage.ru_maxrss * 1024
+
+
+def _peak_memory() -> int:
+	"""The peak resident memory of the process (not its children), in bytes."""
+	try:
+		with open('/proc/self/status') as file:
+			for line in file:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -5,31 +5,41 @@ What it does:
 	- Searches for tweets containing a hashtag with the Twitter API
 	- Converts tweets to words with existing associated video clips
 	- Renders tweets to HTML and then to images using WKHtmlToPdf
+	  (cached by the rendered HTML, so a tweet that looks the same isn't rendered again),
+	  several tweets at once with each wkhtmltoimage process
 """
 
-from typing import Container, Generator, Tuple, Dict, Optional, List
+from typing import Container, Generator, Tuple, Dict, Optional, List, Sequence
 
-from .. import homophones
+from .. import homophones, ffmpeg
+from ..diskcache import DiskCache
 
 import twitter
 import django.template.loader
 from django.utils import safestring
 import imgkit
 
-from os import environ
-from tempfile import NamedTemporaryFile
+from os import environ, PathLike
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+import re
+import shutil
+import threading
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-def tweets(hashtag: str, dictionary: Container[str]) -> Generator[Tuple[List[str], NamedTemporaryFile], None, None]:
+def tweets(hashtag: str, dictionary: Container[str]) -> Generator[Tuple[List[str], Dict], None, None]:
 	"""
 	Gets and processes Twitter posts to be used as YIAY answers.
+	Tweets are not rendered, so only the ones that end up being used have to be (see image).
 	
 	:param hashtag: a Twitter hashtag to find tweets by
 	:param dictionary: words that Jack will be able to say
-	:return: Pairs of tweet images and words to read
+	:return: Pairs of words to read and tweet objects
 	"""
 	if not hashtag.startswith('#'):
 		hashtag = f'#{hashtag}'
@@ -55,7 +65,7 @@ def tweets(hashtag: str, dictionary: Container[str]) -> Generator[Tuple[List[str
 			readable = _get_readable_text(tweet, dictionary)
 			if readable is not None:
 				logger.debug(f'Using tweet {tweet["id_str"]}')
-				yield readable, _image(tweet)
+				yield readable, tweet
 		
 		next_res = res['search_metadata'].get('next_results')
 		if next_res is None:
@@ -109,13 +119,28 @@ def _get_readable_text(tweet: Dict, dictionary: Container[str]) -> Optional[List
 	return words
 
 
-_template = django.template.loader.get_template('yiaygenerator/_tweet.html')
-_OFFSET = 520
+_card_template = django.template.loader.get_template('yiaygenerator/_tweet.html')
+_sheet_template = django.template.loader.get_template('yiaygenerator/_tweets.html')
+CARD_HEIGHT = 720
+"""The height of the page each tweet is laid out in (and the maximum height of a tweet image)."""
+CARD_WIDTH = 520
+"""The width of a tweet image (the crop tweets were rendered with on their own pages, see _page_options)."""
+CARD_BATCH = int(environ.get('CARD_BATCH', 8))
+"""The maximum number of tweets rendered by a single wkhtmltoimage process."""
+CARD_WORKERS = int(environ.get('CARD_WORKERS', 2))
+"""The number of wkhtmltoimage processes that run at once."""
+_STATUS = 'measured'
 _options = {
+	'log-level': 'error',
+	'format': 'png',  # it's cropped to JPEGs later
+	'window-status': _STATUS,  # set by the sheet's script, after the tweets are measured
+}
+_OFFSET = 520
+_page_options = {
 	'log-level': 'error',
 	'selector': '#main',
 	'quality': 100,
-	'height': 720,
+	'height': CARD_HEIGHT,
 	# FIXME
 	# I've been killing bugs from this shit for a week,
 	# and now it decided to move 520px to the left for some reason
@@ -123,23 +148,185 @@ _options = {
 	'crop-x': _OFFSET,
 	'crop-w': _OFFSET,
 }
+"""The options of a tweet on a page of its own, the way they were rendered before the sheets (see compare)."""
+
+cards = DiskCache(
+	environ.get('CARD_CACHE_PATH', 'expr/assets/tweets/'),
+	int(environ.get('CARD_CACHE_BUDGET', 256 * 1024 ** 2)),
+	'.jpg',
+)
+"""Tweet images, by their HTML and rendering options."""
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
 
 
-def _image(tweet: Dict) -> NamedTemporaryFile:
+def _get_pool() -> ThreadPoolExecutor:
+	"""Creates the renderer threads when they're first needed, and keeps them for the next requests."""
+	global _pool
+	with _pool_lock:  # renders are requested from several threads at once
+		if _pool is None:
+			_pool = ThreadPoolExecutor(CARD_WORKERS)
+		return _pool
+
+
+def image(tweet: Dict) -> Path:
 	"""
 	Converts data from a tweet to an image of the tweet.
 	
 	:param tweet: a tweet object from the Twitter API
-	:return: path to the tweet image file.
+	:return: path to the tweet image file (in the cache, so it shouldn't be deleted).
+	"""
+	return images([tweet])[0]
+
+
+def images(tweets: Sequence[Dict]) -> List[Path]:
 	"""
-	file = NamedTemporaryFile(suffix='.jpg')
+	Converts tweets to images, or gets them from the cache if the tweets look the same.
+	The missing tweets are split to batches, which are rendered in parallel,
+	each with a single wkhtmltoimage process (so WebKit is only loaded once for the whole batch).
+	
+	:param tweets: tweet objects from the Twitter API
+	:return: paths to the tweet image files, in the same order (in the cache, so they shouldn't be deleted).
+	"""
+	html = [_card(tweet) for tweet in tweets]
+	keys = [cards.key(card, _options, CARD_HEIGHT, CARD_WIDTH) for card in html]
+	paths = [cards.get(key) for key in keys]
+	
+	missing = {key: card for key, card, path in zip(keys, html, paths) if path is None}
+	if missing:
+		logger.info(f'Rendering {len(missing)} of {len(tweets)} tweets...')
+		items = list(missing.items())
+		size = min(CARD_BATCH, -(-len(items) // CARD_WORKERS))  # spread the tweets over the workers
+		rendered = {}
+		for batch in _get_pool().map(_render, [items[i:i + size] for i in range(0, len(items), size)]):
+			rendered.update(batch)
+		paths = [path or rendered[key] for key, path in zip(keys, paths)]
+	
+	return paths
+
+
+def compare(tweets: Sequence[Dict], directory: PathLike) -> List[Optional[float]]:
+	"""
+	Renders tweets both on pages of their own (the way they were rendered before the sheets)
+	and in a sheet, to check that they're cropped the same.
+	Both images of each tweet are written to a directory ({n}-page.jpg and {n}-sheet.jpg) to look at.
+	
+	:param tweets: tweet objects from the Twitter API
+	:param directory: the directory to write the images to
+	:return:
+		The PSNR between the two images of each tweet, in dB
+		(high, but not infinite, since they're encoded differently), or None if their sizes differ.
+	"""
+	directory = Path(directory)
+	directory.mkdir(parents=True, exist_ok=True)
+	html = [_card(tweet) for tweet in tweets]
+	batch = [(cards.key(card, _options, CARD_HEIGHT, CARD_WIDTH), card) for card in html]
+	sheet = _render(batch)
+	
+	results = []
+	for n, (key, card) in enumerate(batch):
+		page, cropped = directory / f'{n}-page.jpg', directory / f'{n}-sheet.jpg'
+		imgkit.from_string(_sheet_template.render({'page': card}), str(page), _page_options)
+		shutil.copyfile(str(sheet[key]), str(cropped))
+		
+		before, after = ffmpeg.info(page), ffmpeg.info(cropped)
+		if (before.width, before.height) != (after.width, after.height):
+			logger.warning(
+				f'Tweet #{n} is {before.width}x{before.height} on its page, '
+				f'{after.width}x{after.height} in the sheet.'
+			)
+			results.append(None)
+			continue
+		
+		log = ffmpeg.run('-i', str(page), '-i', str(cropped), '-lavfi', 'psnr', '-f', 'null', '-')
+		results.append(float(re.findall(r'average:(\S+)', log)[-1]))
 	
-	imgkit.from_string(_template.render({
+	return results
+
+
+def _card(tweet: Dict) -> str:
+	"""Renders a tweet to HTML."""
+	return _card_template.render({
 		**tweet,
 		'full_text': _get_display_text(tweet),
-	}), file.name, _options)
+	})
+
+
+def _render(batch: List[Tuple[str, str]]) -> Dict[str, Path]:
+	"""
+	Renders a batch of tweets to a single image, with each tweet in its own cell,
+	and crops the tweets out of the cells to the cache.
+	Tweets that weren't measured are rendered again on their own,
+	so a single tweet doesn't fail the batch.
+	
+	:param batch: pairs of cache keys and tweet HTML
+	:return: the paths of the tweet images by their keys
+	"""
+	with NamedTemporaryFile(suffix='.png') as sheet, TemporaryDirectory() as directory:
+		imgkit.from_string(_sheet_template.render({
+			'cards': [(i * CARD_HEIGHT, card) for i, (_, card) in enumerate(batch)],
+			'height': CARD_HEIGHT,
+			'width': CARD_WIDTH,
+			'status': _STATUS,
+		}), sheet.name, {**_options, 'height': len(batch) * CARD_HEIGHT})
+		
+		heights = _heights(sheet.name, len(batch))
+		if len(batch) == 1 and not heights[0]:
+			logger.warning('Failed to measure a tweet on its own, using its whole cell.')
+			heights = [CARD_HEIGHT]
+		
+		measured = [i for i, height in enumerate(heights) if height]
+		outputs = [str(Path(directory, f'{i}.jpg')) for i in measured]
+		if measured:
+			_crop(sheet.name, [(i * CARD_HEIGHT, heights[i]) for i in measured], outputs)
+		rendered = {batch[i][0]: cards.put(batch[i][0], output) for i, output in zip(measured, outputs)}
+	
+	unmeasured = [item for item, height in zip(batch, heights) if not height]
+	if unmeasured:
+		logger.warning(f'Failed to measure {len(unmeasured)} of {len(batch)} tweets, rendering them on their own.')
+		for item in unmeasured:
+			rendered.update(_render([item]))
+	
+	return rendered
+
+
+def _heights(sheet: str, count: int) -> List[int]:
+	"""
+	Measures the tweets in a sheet by the rulers next to them
+	(white for the height of the tweet, black below it).
+	
+	:param sheet: the sheet image
+	:param count: the number of cells in the sheet
+	:return: the height of the tweet in each cell, or 0 if it wasn't measured
+	:raise IOError: if ffmpeg fails
+	"""
+	process = ffmpeg.popen(
+		'-i', sheet, '-vf', f'crop=1:ih:{CARD_WIDTH}:0,format=gray', '-f', 'rawvideo', '-',
+		stdout=subprocess.PIPE,
+	)
+	ruler, _ = process.communicate()
+	if process.returncode:
+		raise IOError(f'Reading {sheet} failed (ffmpeg exited with {process.returncode})')
+	
+	return [sum(v > 127 for v in ruler[i * CARD_HEIGHT:(i + 1) * CARD_HEIGHT]) for i in range(count)]
+
+
+def _crop(sheet: str, cells: List[Tuple[int, int]], outputs: List[str]) -> None:
+	"""
+	Crops tweets out of a sheet to separate files, with a single ffmpeg run.
+	
+	:param sheet: the sheet image
+	:param cells: the top of each tweet's cell, and the tweet's height
+	:param outputs: the path to write each tweet to
+	"""
+	graph = f'[0]split={len(outputs)}' + ''.join(f'[s{i}]' for i in range(len(outputs)))
+	args = []
+	for i, ((top, height), output) in enumerate(zip(cells, outputs)):
+		graph += f';[s{i}]crop={CARD_WIDTH}:{height}:0:{top}[c{i}]'
+		args += ['-map', f'[c{i}]', '-q:v', '1', output]
 	
-	return file
+	ffmpeg.run('-i', sheet, '-filter_complex', graph, *args)
 
 
 def _get_display_text(tweet: Dict) -> safestring.SafeText:
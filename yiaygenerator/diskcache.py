@@ -0,0 +1,121 @@
+"""
+A directory of cached files with a size budget.
+When the files take more space than the budget, the least recently used ones are deleted.
+
+Several processes can share the same directory:
+files are written to temporary files and then renamed,
+and the last time a file was used is stored as its modification time.
+"""
+
+from typing import Optional, List, Tuple, Any, Callable
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import logging
+from os import PathLike
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+_PART = '.part'
+
+
+class DiskCache:
+	"""Files stored by key in a directory, with LRU eviction."""
+	def __init__(self, directory: PathLike, budget: int, suffix: str = '') -> None:
+		"""
+		:param directory: the directory to store the files in
+		:param budget: the maximum total size of the files, in bytes
+		:param suffix: the extension of the files
+		"""
+		self.directory = Path(directory)
+		self.budget = budget
+		self.suffix = suffix
+	
+	@staticmethod
+	def key(*parts: Any) -> str:
+		"""Makes a key out of JSON-serializable parts."""
+		return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+	
+	def path(self, key: str) -> Path:
+		"""Returns the path a file is stored at (whether it exists or not)."""
+		return self.directory / f'{key}{self.suffix}'
+	
+	def get(self, key: str) -> Optional[Path]:
+		"""
+		Gets a file from the cache, and marks it as used.
+		
+		:param key: the file's key
+		:return: the file's path, or None if it's not in the cache
+		"""
+		path = self.path(key)
+		try:
+			os.utime(path)
+		except FileNotFoundError:
+			return None
+		return path
+	
+	def put(self, key: str, source: PathLike) -> Path:
+		"""
+		Adds a copy of a file to the cache, replacing the file with the same key,
+		and evicts files if the cache is over its budget.
+		
+		:param key: the file's key
+		:param source: the file to copy
+		:return: the path of the copy
+		"""
+		return self._store(key, lambda part: shutil.copyfile(str(source), part))
+	
+	def write(self, key: str, data: bytes) -> Path:
+		"""
+		Adds a file with some data to the cache, like put.
+		
+		:param key: the file's key
+		:param data: the file's content
+		:return: the path of the file
+		"""
+		return self._store(key, lambda part: Path(part).write_bytes(data))
+	
+	def _store(self, key: str, write: Callable[[str], Any]) -> Path:
+		"""Writes a file to a temporary path, and then moves it to the key's path."""
+		path = self.path(key)
+		self.directory.mkdir(parents=True, exist_ok=True)
+		
+		fd, part = tempfile.mkstemp(_PART, dir=str(self.directory))
+		os.close(fd)
+		try:
+			write(part)
+			os.replace(part, str(path))
+		except BaseException:
+			os.unlink(part)
+			raise
+		
+		self.evict()
+		return path
+	
+	def evict(self) -> None:
+		"""Deletes the least recently used files until the cache is within its budget."""
+		files: List[Tuple[float, int, Path]] = []
+		for path in self.directory.iterdir():
+			if path.suffix == _PART:
+				continue
+			try:
+				stat = path.stat()
+			except FileNotFoundError:  # deleted by another process
+				continue
+			files.append((stat.st_mtime, stat.st_size, path))
+		
+		total = sum(size for _, size, _ in files)
+		for _, size, path in sorted(files):
+			if total <= self.budget:
+				break
+			
+			logger.debug(f'Evicting {path.name}')
+			try:
+				path.unlink()
+			except FileNotFoundError:
+				pass
+			total -= size
@@ -0,0 +1,151 @@
+"""
+Runs the ffmpeg binary directly,
+for jobs that don't need moviepy's frame-by-frame processing
+(cutting and joining video files without re-encoding them).
+"""
+
+from typing import List, Iterable, Iterator, NamedTuple, Optional
+
+import imageio_ffmpeg
+
+import re
+import subprocess
+import contextlib
+import tempfile
+from os import PathLike
+from pathlib import Path
+
+executable = imageio_ffmpeg.get_ffmpeg_exe()
+
+_pts_time = re.compile(r'pts_time:\s*(\d+(?:\.\d+)?)')
+_duration = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+_video_stream = re.compile(r'Stream #0:\d+.*?: Video: .*?, (\d+)x(\d+)(?:.*?, ([\d.]+) fps)?')
+_audio_stream = re.compile(r'Stream #0:\d+.*?: Audio: ')
+
+
+class Info(NamedTuple):
+	"""Basic properties of a video file."""
+	duration: Optional[float]
+	width: int
+	height: int
+	fps: Optional[float]
+	audio: bool
+	"""Whether the file has an audio stream."""
+
+
+def run(*args: str) -> str:
+	"""
+	Runs ffmpeg with some arguments.
+	
+	:param args: command line arguments for ffmpeg
+	:return: ffmpeg's log output
+	:raise IOError: if ffmpeg fails
+	"""
+	process = subprocess.run(
+		[executable, '-hide_banner', '-nostdin', '-y', *args],
+		stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+	)
+	log = process.stderr.decode(errors='replace')
+	if process.returncode != 0:
+		raise IOError(f'ffmpeg exited with {process.returncode}: {log[-500:]}')
+	
+	return log
+
+
+def popen(*args: str, **kwargs) -> subprocess.Popen:
+	"""
+	Starts ffmpeg with some arguments, for streaming data through its pipes.
+	Only errors are logged (to stderr), so the pipes aren't blocked by an unread log.
+	
+	:param args: command line arguments for ffmpeg
+	:param kwargs: arguments for Popen
+	:return: the running process
+	"""
+	return subprocess.Popen([executable, '-hide_banner', '-nostdin', '-loglevel', 'error', '-y', *args], **kwargs)
+
+
+def info(path: PathLike) -> Info:
+	"""
+	Reads the basic properties of a video file from its header.
+	
+	:param path: path to the video file
+	:return: the file's duration, frame size, frame rate and whether it has audio
+	:raise IOError: if the file has no video stream
+	"""
+	log = run('-i', str(path), '-map', '0:v:0', '-frames:v', '0', '-f', 'null', '-')
+	
+	video = _video_stream.search(log)
+	if video is None:
+		raise IOError(f'No video stream in {path}')
+	duration = _duration.search(log)
+	
+	return Info(
+		duration=duration and 3600 * int(duration[1]) + 60 * int(duration[2]) + float(duration[3]),
+		width=int(video[1]),
+		height=int(video[2]),
+		fps=video[3] and float(video[3]),
+		audio=_audio_stream.search(log) is not None,
+	)
+
+
+def keyframes(path: PathLike) -> List[float]:
+	"""
+	Lists the times of the keyframes in a video file.
+	Only keyframes are decoded, so it's pretty fast.
+	
+	:param path: path to the video file
+	:return: sorted keyframe times, in seconds
+	"""
+	log = run(
+		'-skip_frame', 'nokey', '-i', str(path),
+		'-map', '0:v:0', '-vf', 'showinfo', '-f', 'null', '-',
+	)
+	return sorted(float(t) for t in _pts_time.findall(log))
+
+
+def concat(paths: Iterable[PathLike], output: PathLike) -> None:
+	"""
+	Joins video files at the container level, without re-encoding.
+	The files must share the same codecs and encoding parameters.
+	
+	:param paths: the files to join, in order
+	:param output: path to the joined file
+	"""
+	with listing(paths) as paths_listing:
+		run('-f', 'concat', '-safe', '0', '-i', paths_listing, '-c', 'copy', str(output))
+
+
+def fragment(paths: Iterable[PathLike], output: PathLike, offset: float = 0.0) -> None:
+	"""
+	Joins video files into a fragmented mp4, without re-encoding,
+	so it can be played while it's being streamed (see Media Source Extensions).
+	
+	:param paths: the files to join, in order
+	:param output: path to the fragmented file
+	:param offset: the time the fragments start at, when they continue a stream
+	"""
+	with listing(paths) as paths_listing:
+		run(
+			'-f', 'concat', '-safe', '0', '-i', paths_listing, '-c', 'copy',
+			'-output_ts_offset', f'{offset:.6f}',
+			'-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+			'-f', 'mp4', str(output),
+		)
+
+
+@contextlib.contextmanager
+def listing(paths: Iterable[PathLike]) -> Iterator[str]:
+	"""
+	Writes a listing of files for the concat demuxer (-f concat -safe 0 -i <listing>).
+	
+	:param paths: the files to list, in order
+	:return: the path to the listing, which is deleted afterwards
+	"""
+	with tempfile.NamedTemporaryFile('w', suffix='.txt') as file:
+		for path in paths:
+			# paths in the listing are relative to the listing itself, so make them absolute
+			escaped = str(Path(path).resolve()).replace("'", "'\\''")
+			file.write(f"file '{escaped}'\n")
+		file.flush()
+		
+		yield file.name
@@ -1,12 +1,16 @@
 """Basic Django Channels routing."""
 
 from channels import routing
+from django.conf import settings
 import django.urls
 
-from . import consumers
+from . import consumers, workers
 
 application = routing.ProtocolTypeRouter({
 	'websocket': routing.URLRouter([
 		django.urls.path('request/', consumers.YiayConsumer),
 	]),
+	'channel': routing.ChannelNameRouter({
+		settings.RENDER_CHANNEL: workers.RenderConsumer,
+	} if settings.RENDER_CHANNEL else {}),
 })
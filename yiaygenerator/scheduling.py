@@ -0,0 +1,296 @@
+"""
+Schedules video generation for the websocket clients.
+
+Only a fixed number of videos are generated at once, and a limited number of jobs can wait for a worker;
+when the queue is full, new requests are rejected right away instead of slowing every job down.
+Identical requests share a single job, and all of its clients get the same video.
+A job only streams the video while it's generated if one of its clients asked for it,
+and the streamed data is spooled to a temporary file for the clients that join later.
+
+Everything here runs on the event loop, except for the generation itself.
+The results are sent as channel messages (see serve), so they can be sent over the channel layer
+by render workers (see the workers module) or handled directly by the consumer.
+"""
+
+from typing import Tuple, Dict, Set, Deque, Optional, Any, BinaryIO, Callable, Awaitable
+
+from . import core, ffmpeg
+
+import os
+import asyncio
+import functools
+import tempfile
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get('GENERATION_WORKERS', 2))
+"""The number of videos that are generated at once."""
+MAX_QUEUE = int(os.environ.get('GENERATION_QUEUE', 8))
+"""The number of jobs that can wait for a worker."""
+CHUNK_SIZE = 64 * 1024
+"""Maximum size of a single data message."""
+
+Key = Tuple[str, str, float, bool]
+"""The question, hashtag and duration of a video, and whether it's a preview."""
+Event = Tuple[str, Any]
+
+QUEUED = 'queued'
+"""The job's position in the queue changed (1 is next)."""
+PROGRESS = 'progress'
+"""The fraction of the job that is done changed."""
+FRAGMENT = 'fragment'
+"""The next part of the video is ready to be streamed (see core.rendering.Stream)."""
+SPOOLED = 'spooled'
+"""The length of the video that was streamed before the client joined (see Subscription.read_spool)."""
+DONE = 'done'
+"""The job is finished (successfully or not)."""
+
+
+class Saturated(Exception):
+	"""Raised when there are too many jobs waiting."""
+
+
+class Job:
+	"""The generation of a single video, and the clients waiting for it."""
+	def __init__(self, key: Key, stream: bool = False) -> None:
+		self.key = key
+		self.stream = stream
+		"""Whether the video is streamed while it's generated."""
+		self.subscriptions: Set['Subscription'] = set()
+		self.progress = 0.0
+		self.spool: Optional[BinaryIO] = None
+		"""The streamed data, for the clients that join later."""
+		self.spooled = 0
+		self.done = False
+		self.video: Optional[BinaryIO] = None
+		self.error: Optional[BaseException] = None
+	
+	def publish(self, event: Event) -> None:
+		"""Sends an event to all the job's clients."""
+		if event[0] == PROGRESS:
+			self.progress = event[1]
+		elif event[0] == FRAGMENT:
+			if self.spool is None:
+				self.spool = tempfile.TemporaryFile(buffering=0)
+			self.spool.write(event[1])
+			self.spooled += len(event[1])
+		for subscription in self.subscriptions:
+			subscription.events.put_nowait(event)
+	
+	def release(self, subscription: 'Subscription') -> None:
+		"""Removes a client, and deletes the video when there are no clients left."""
+		self.subscriptions.discard(subscription)
+		if self.done and not self.subscriptions:
+			self.close()
+	
+	def close(self) -> None:
+		"""Deletes the video and the spool."""
+		for file in self.video, self.spool:
+			if file is not None:
+				file.close()
+		self.video = self.spool = None
+
+
+class Subscription:
+	"""A client's handle to a job."""
+	def __init__(self, scheduler: 'Scheduler', job: Job) -> None:
+		self.scheduler = scheduler
+		self.job = job
+		self.events: asyncio.Queue = asyncio.Queue()
+	
+	async def next(self) -> Event:
+		"""Waits for the next event of the job."""
+		return await self.events.get()
+	
+	def open(self) -> BinaryIO:
+		"""
+		Opens the finished video for reading.
+		
+		:raise: the job's exception if it failed
+		"""
+		if self.job.error is not None:
+			raise self.job.error
+		return open(self.job.video.name, 'rb')
+	
+	def read_spool(self, offset: int, size: int) -> bytes:
+		"""Reads streamed data from the job's spool (safe to call from another thread)."""
+		return os.pread(self.job.spool.fileno(), size, offset)
+	
+	def close(self) -> None:
+		"""Stops waiting for the job (cancelling it if nobody else is waiting and it didn't start yet)."""
+		self.scheduler._unsubscribe(self)
+
+
+class Scheduler:
+	"""Runs jobs in a bounded pool of worker threads, with a bounded queue."""
+	def __init__(self, workers: int, max_queue: int) -> None:
+		self.workers = workers
+		self.max_queue = max_queue
+		self._jobs: Dict[Key, Job] = {}
+		self._queue: Deque[Job] = deque()
+		self._running = 0
+		self._executor: Optional[ThreadPoolExecutor] = None
+	
+	def subscribe(self, key: Key, stream: bool = False) -> Subscription:
+		"""
+		Gets a handle to the job generating a video,
+		starting a new job if there isn't one already.
+		
+		:param key: the video to generate
+		:param stream: whether the client wants the video streamed while it's generated
+			(if the job already started without streaming, the client gets the video when it's done)
+		:raise Saturated: if the job is new and the queue is full
+		"""
+		job = self._jobs.get(key)
+		if job is None:
+			if self._running >= self.workers and len(self._queue) >= self.max_queue:
+				raise Saturated(f'{len(self._queue)} jobs are already waiting')
+			
+			job = self._jobs[key] = Job(key, stream)
+			self._queue.append(job)
+			logger.info(f'Queued {key}')
+		else:
+			logger.info(f'Joined {key}')
+			if stream and job in self._queue:
+				job.stream = True
+		
+		subscription = Subscription(self, job)
+		job.subscriptions.add(subscription)
+		# catch up with the job
+		if stream and job.spooled:
+			subscription.events.put_nowait((SPOOLED, job.spooled))
+		if job.progress:
+			subscription.events.put_nowait((PROGRESS, job.progress))
+		
+		self._dispatch()
+		return subscription
+	
+	def _unsubscribe(self, subscription: Subscription) -> None:
+		job = subscription.job
+		job.release(subscription)
+		if not job.subscriptions and job in self._queue:
+			logger.info(f'Dropped {job.key}')
+			self._queue.remove(job)
+			del self._jobs[job.key]
+			self._dispatch()
+	
+	def _dispatch(self) -> None:
+		"""Starts waiting jobs while there are free workers, and updates the positions of the others."""
+		while self._running < self.workers and self._queue:
+			self._start(self._queue.popleft())
+		
+		for position, job in enumerate(self._queue, 1):
+			job.publish((QUEUED, position))
+	
+	def _start(self, job: Job) -> None:
+		if self._executor is None:
+			self._executor = ThreadPoolExecutor(self.workers)
+		
+		loop = asyncio.get_event_loop()
+		
+		# called from the worker thread
+		def progress(done: float) -> None:
+			loop.call_soon_threadsafe(job.publish, (PROGRESS, done))
+		
+		def stream(fragment: bytes) -> None:
+			loop.call_soon_threadsafe(job.publish, (FRAGMENT, fragment))
+		
+		question, hashtag, duration, preview = job.key
+		self._running += 1
+		future = loop.run_in_executor(self._executor, functools.partial(
+			core.yiay, question, hashtag, duration, progress, stream if job.stream else None, preview,
+		))
+		future.add_done_callback(functools.partial(self._finish, job))
+	
+	def _finish(self, job: Job, future: asyncio.Future) -> None:
+		self._running -= 1
+		del self._jobs[job.key]
+		
+		job.done = True
+		if future.exception() is None:
+			job.video = future.result()
+		else:
+			job.error = future.exception()
+			logger.error(f'Failed to generate {job.key}', exc_info=job.error)
+		
+		job.publish((DONE, None))
+		if not job.subscriptions:
+			job.close()
+		
+		self._dispatch()
+
+
+scheduler = Scheduler(WORKERS, MAX_QUEUE)
+"""The scheduler of the current process."""
+
+
+async def serve(key: Key, send: Callable[[Dict], Awaitable[None]], stream: bool = False) -> None:
+	"""
+	Generates a video with the scheduler, and sends its progress and data as channel messages:
+		- render.queued (position) and render.progress (done) while the video is generated
+		- render.fragment (data), a chunk of the video as fragmented mp4, in order, while it's generated,
+		  if streaming (or when it's done, if the client joined a job that didn't stream)
+		- render.data (data), a chunk of the video, in order, when it's done, if not streaming
+		- and finally render.done, render.failed or render.rejected (if the scheduler is saturated)
+	
+	:param key: the video to generate
+	:param send: a coroutine function that sends a message
+	:param stream: whether to stream the video while it's generated
+	"""
+	try:
+		subscription = scheduler.subscribe(key, stream)
+	except Saturated:
+		await send({'type': 'render.rejected'})
+		return
+	
+	loop = asyncio.get_event_loop()
+	try:
+		while True:
+			event, value = await subscription.next()
+			if event == QUEUED:
+				await send({'type': 'render.queued', 'position': value})
+			elif event == PROGRESS:
+				await send({'type': 'render.progress', 'done': value})
+			elif event == SPOOLED:
+				for offset in range(0, value, CHUNK_SIZE):
+					data = await loop.run_in_executor(
+						None, subscription.read_spool, offset, min(CHUNK_SIZE, value - offset),
+					)
+					await send({'type': 'render.fragment', 'data': data})
+			elif event == FRAGMENT:
+				if stream:
+					for i in range(0, len(value), CHUNK_SIZE):
+						await send({'type': 'render.fragment', 'data': value[i:i + CHUNK_SIZE]})
+			else:
+				break
+		
+		try:
+			video = subscription.open()
+		except Exception:
+			await send({'type': 'render.failed'})
+			return
+		
+		with video:
+			if not stream:
+				await _send_file(video, 'render.data', send)
+			elif not subscription.job.stream:  # otherwise it was already sent
+				with tempfile.NamedTemporaryFile(suffix='.mp4') as fragment:
+					await loop.run_in_executor(None, ffmpeg.fragment, [video.name], fragment.name)
+					await _send_file(fragment, 'render.fragment', send)
+	finally:
+		subscription.close()
+	
+	await send({'type': 'render.done'})
+
+
+async def _send_file(file: BinaryIO, message_type: str, send: Callable[[Dict], Awaitable[None]]) -> None:
+	"""Sends a file as messages of a type, a chunk at a time."""
+	loop = asyncio.get_event_loop()
+	while True:
+		chunk = await loop.run_in_executor(None, file.read, CHUNK_SIZE)
+		if not chunk:
+			break
+		await send({'type': message_type, 'data': chunk})
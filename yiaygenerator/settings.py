@@ -74,6 +74,30 @@ TEMPLATES = [
 WSGI_APPLICATION = 'yiaygenerator.wsgi.application'
 ASGI_APPLICATION = 'yiaygenerator.routing.application'
 
+# Channels
+# https://channels.readthedocs.io/en/latest/topics/channel_layers.html
+
+if 'REDIS_URL' in os.environ:
+	CHANNEL_LAYERS = {
+		'default': {
+			'BACKEND': 'channels_redis.core.RedisChannelLayer',
+			'CONFIG': {
+				'hosts': [os.environ['REDIS_URL']],
+			},
+		},
+	}
+else:
+	# only reaches workers in the same process (like tests)
+	CHANNEL_LAYERS = {
+		'default': {
+			'BACKEND': 'channels.layers.InMemoryChannelLayer',
+		},
+	}
+
+# The channel of the render workers (manage.py runworker <channel>),
+# or None to render in the web process
+RENDER_CHANNEL = os.environ.get('RENDER_CHANNEL')
+
 # LOGGING = {
 # 	'version': 1,
 # 	'disable_existing_loggers': False,
@@ -0,0 +1,59 @@
+"""
+Render workers, which generate videos for the websocket consumers of other processes (or hosts).
+
+Run with: manage.py runworker <RENDER_CHANNEL>
+Each worker process has its own scheduler, so it only takes as many jobs as it can handle,
+and identical requests that reach the same worker share a job.
+"""
+
+from typing import Dict
+
+from channels.consumer import AsyncConsumer
+from channels.exceptions import ChannelFull
+
+from . import scheduling
+
+import asyncio
+import functools
+
+RETRY_DELAY = 0.1
+"""Seconds to wait before sending to a full reply channel again."""
+
+
+class RenderConsumer(AsyncConsumer):
+	"""
+	Handles render requests from YiayConsumers,
+	and sends render.* messages back to their reply channels (see scheduling.serve).
+	"""
+	def __init__(self, *args, **kwargs) -> None:
+		super().__init__(*args, **kwargs)
+		self._tasks: Dict[str, asyncio.Future] = {}
+	
+	async def render_request(self, message: Dict) -> None:
+		"""Starts serving a request (without waiting for it, so the next messages are handled)."""
+		reply_channel = message['reply_channel']
+		key = message['question'], message['hashtag'], message['duration'], message.get('preview', False)
+		self._tasks[reply_channel] = asyncio.ensure_future(
+			self._serve(key, reply_channel, message.get('stream', False))
+		)
+	
+	async def render_cancel(self, message: Dict) -> None:
+		"""Stops serving a client that disconnected."""
+		task = self._tasks.pop(message['reply_channel'], None)
+		if task is not None:
+			task.cancel()
+	
+	async def _serve(self, key: scheduling.Key, reply_channel: str, stream: bool) -> None:
+		try:
+			await scheduling.serve(key, functools.partial(self._reply, reply_channel), stream)
+		finally:
+			self._tasks.pop(reply_channel, None)
+	
+	async def _reply(self, reply_channel: str, message: Dict) -> None:
+		"""Sends a message to a client, waiting for it to catch up if its channel is full."""
+		while True:
+			try:
+				await self.channel_layer.send(reply_channel, message)
+				return
+			except ChannelFull:
+				await asyncio.sleep(RETRY_DELAY)